@@ -1,8 +1,8 @@
 import os
 import sys
 import time
-from pyaudio import PyAudio, paInt16, paContinue
-from numpy import zeros, frombuffer, int16, pi, exp, sin
+from numpy import zeros, pi, exp, sin
+from mic_service import subscribe
 from PySide6.QtCore import Qt, QTimer, QPoint
 from PySide6.QtGui import QRegion, QColor, QPainter, QPixmap
 from PySide6.QtWidgets import QApplication, QWidget
@@ -38,35 +38,20 @@ class JarvisWaveform(QWidget):
         self.init_audio_stream()
 
         self.timer = QTimer()
-        self.timer.timeout.connect(self.update)
+        self.timer.timeout.connect(self.update_audio_data)
         self.timer.start(20)
 
         self.start_time = time.time()
         self.setStyleSheet("background-color: transparent; border: none;")
 
     def init_audio_stream(self):
-        """Initialize the audio stream."""
-        self.p = PyAudio()
-        self.stream = self.p.open(format=paInt16, channels=1, rate=44100, input=True, frames_per_buffer=1024,
-                                  stream_callback=self.audio_callback)
-
-    def audio_callback(self, in_data, frame_count, time_info, status):
-        """Process the audio data from the stream.
-
-        :param in_data: input data
-        :type in_data: bytes
-        :param frame_count: number of frames
-        :type frame_count: int
-        :param time_info: time information
-        :type time_info: dict
-        :param status: stream status
-        :type status: int
-        :return: stream status
-        :rtype: int
-        """
-        audio_data = frombuffer(in_data, dtype=int16)
-        self.audio_data = audio_data
-        return None, paContinue
+        """Subscribe to the shared microphone."""
+        self.stream = subscribe()
+
+    def update_audio_data(self):
+        """Fetch the latest audio from the shared microphone and repaint."""
+        self.audio_data = self.stream.latest(len(self.audio_data))
+        self.update()
 
     def draw_icon(self, painter, icon, opacity):
         """Draw the icon with the given opacity.
@@ -243,15 +228,13 @@ class JarvisWaveform(QWidget):
 
     def force_close(self):
         """Forcefully close the widget."""
-        self.stream.stop_stream()
+        self.timer.stop()
         self.stream.close()
-        self.p.terminate()
 
     def closeEvent(self, event):
         """Handle the close event."""
-        self.stream.stop_stream()
+        self.timer.stop()
         self.stream.close()
-        self.p.terminate()
 
 
 if __name__ == "__main__":
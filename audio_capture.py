@@ -0,0 +1,254 @@
+from numpy import ndarray, asarray, zeros, multiply, dot, sqrt, dtype as np_dtype, int16, int32, float32, float64, \
+    abs as np_abs
+from pyaudio import PyAudio, paInt16
+
+# Configuration
+initial_capture_seconds = 30  # Preallocated recording length, doubled whenever it fills up
+
+
+class CaptureBuffer:
+    """
+    A preallocated buffer that recorded chunks are copied into.
+
+    Appending is amortized O(1): the buffer starts large enough for initial_capture_seconds of audio and doubles
+    when it fills, instead of rebuilding the whole recording for every chunk. A float32 buffer converts int16 chunks
+    to the -1 to 1 range as they are written, so the recording can be handed straight to Whisper.
+
+    :param sample_rate: The sample rate of the recorded audio.
+    :type sample_rate: int
+    :param seconds: The number of seconds to preallocate.
+    :type seconds: float
+    :param sample_type: The type the samples are stored as, int16 or float32.
+    :type sample_type: numpy.dtype
+    """
+
+    def __init__(self, sample_rate: int, seconds: float = initial_capture_seconds, sample_type=int16) -> None:
+        """
+        Allocate the buffer.
+
+        :param sample_rate: The sample rate of the recorded audio.
+        :type sample_rate: int
+        :param seconds: The number of seconds to preallocate.
+        :type seconds: float
+        :param sample_type: The type the samples are stored as, int16 or float32.
+        :type sample_type: numpy.dtype
+        """
+        self.sample_rate = sample_rate
+        self.sample_type = np_dtype(sample_type)
+        self.data = zeros(max(int(sample_rate * seconds), 1), dtype=self.sample_type)
+        self.length = 0
+
+    def append(self, samples: ndarray) -> ndarray:
+        """
+        Copy samples onto the end of the recording.
+
+        :param samples: int16 samples.
+        :type samples: numpy.ndarray
+        :return: A view of the newly written samples.
+        :rtype: numpy.ndarray
+        """
+        needed = self.length + len(samples)
+        if needed > len(self.data):
+            size = len(self.data)
+            while size < needed:
+                size *= 2
+            grown = zeros(size, dtype=self.sample_type)
+            grown[:self.length] = self.data[:self.length]
+            self.data = grown
+        written = self.data[self.length:needed]
+        if self.sample_type == float32 and samples.dtype == int16:
+            multiply(samples, 1 / 32768, out=written, casting="unsafe")
+        else:
+            written[:] = samples
+        self.length = needed
+        return written
+
+    def view(self) -> ndarray:
+        """
+        Get the recorded samples without copying them.
+
+        :return: A view of the recorded samples.
+        :rtype: numpy.ndarray
+        """
+        return self.data[:self.length]
+
+    def tobytes(self) -> bytes:
+        """
+        Get the recorded samples as raw bytes in the buffer's sample type.
+
+        :return: The recorded audio.
+        :rtype: bytes
+        """
+        return self.view().tobytes()
+
+    def duration(self) -> float:
+        """
+        Get the length of the recording.
+
+        :return: The recorded duration in seconds.
+        :rtype: float
+        """
+        return self.length / self.sample_rate
+
+    def clear(self) -> None:
+        """
+        Forget the recorded samples but keep the allocation.
+        """
+        self.length = 0
+
+
+class RollingEnergy:
+    """
+    A fixed size ring of per-chunk volumes with an O(1) running average.
+
+    :param window_size: The number of chunks to average over.
+    :type window_size: int
+    """
+
+    def __init__(self, window_size: int) -> None:
+        """
+        Allocate the ring.
+
+        :param window_size: The number of chunks to average over.
+        :type window_size: int
+        """
+        self.values = zeros(window_size, dtype=float64)
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, volume: float) -> float:
+        """
+        Add the volume of a new chunk, dropping the oldest one once the window is full.
+
+        :param volume: The volume of the new chunk.
+        :type volume: float
+        :return: The average volume over the window.
+        :rtype: float
+        """
+        window_size = len(self.values)
+        if self.count == window_size:
+            self.total -= self.values[self.index]
+        else:
+            self.count += 1
+        self.values[self.index] = volume
+        self.total += volume
+        self.index = (self.index + 1) % window_size
+        return self.average()
+
+    def average(self) -> float:
+        """
+        Get the average volume over the window.
+
+        :return: The average volume, 0 if nothing has been added.
+        :rtype: float
+        """
+        if self.count == 0:
+            return 0.0
+        return max(self.total / self.count, 0.0)
+
+
+def chunk_volume(samples: ndarray) -> float:
+    """
+    Get the mean absolute amplitude of a chunk of int16 samples.
+
+    The samples are widened first so -32768 does not overflow when its absolute value is taken.
+
+    :param samples: int16 samples.
+    :type samples: numpy.ndarray
+    :return: The mean absolute amplitude.
+    :rtype: float
+    """
+    if len(samples) == 0:
+        return 0.0
+    return float(np_abs(samples.astype(int32)).mean())
+
+
+def chunk_rms(samples: ndarray) -> float:
+    """
+    Get the root mean square amplitude of a chunk of int16 samples.
+
+    :param samples: int16 samples, as an array or any sequence.
+    :type samples: numpy.ndarray or tuple
+    :return: The RMS amplitude.
+    :rtype: float
+    """
+    if len(samples) == 0:
+        return 0.0
+    widened = asarray(samples, dtype=float64)
+    return float(sqrt(dot(widened, widened) / len(widened)))
+
+
+class NoiseFloorTracker:
+    """
+    Follows the ambient noise level continuously so the energy threshold never needs a blocking calibration.
+
+    The threshold is an asymmetric moving average of each chunk's RMS times a ratio: it drops quickly when the room
+    gets quieter and rises slowly, so a few seconds of speech barely move it but a new steady noise is learned.
+
+    :param threshold: The starting energy threshold.
+    :type threshold: float
+    :param ratio: How far above the noise floor the threshold sits.
+    :type ratio: float
+    :param fall_damping: The fraction of the old threshold kept per second when the room gets quieter.
+    :type fall_damping: float
+    :param rise_damping: The fraction of the old threshold kept per second when the room gets louder.
+    :type rise_damping: float
+    """
+
+    def __init__(self, threshold: float, ratio: float = 1.5, fall_damping: float = 0.15,
+                 rise_damping: float = 0.97) -> None:
+        """
+        Initialize the tracker.
+
+        :param threshold: The starting energy threshold.
+        :type threshold: float
+        :param ratio: How far above the noise floor the threshold sits.
+        :type ratio: float
+        :param fall_damping: The fraction of the old threshold kept per second when the room gets quieter.
+        :type fall_damping: float
+        :param rise_damping: The fraction of the old threshold kept per second when the room gets louder.
+        :type rise_damping: float
+        """
+        self.threshold = threshold
+        self.ratio = ratio
+        self.fall_damping = fall_damping
+        self.rise_damping = rise_damping
+
+    def update(self, samples, sample_rate: int) -> float:
+        """
+        Fold a chunk of ambient audio into the threshold.
+
+        :param samples: int16 samples, as an array or any sequence.
+        :type samples: numpy.ndarray or tuple
+        :param sample_rate: The sample rate of the chunk.
+        :type sample_rate: int
+        :return: The updated threshold.
+        :rtype: float
+        """
+        seconds = len(samples) / sample_rate
+        target = chunk_rms(samples) * self.ratio
+        damping = (self.fall_damping if target < self.threshold else self.rise_damping) ** seconds
+        self.threshold = self.threshold * damping + target * (1 - damping)
+        return self.threshold
+
+
+def choose_input_rate(p: PyAudio, preferred: int = 16000) -> int:
+    """
+    Pick the rate to open the default input device at, preferring one that needs no resampling.
+
+    :param p: The PyAudio instance the stream will be opened with.
+    :type p: PyAudio
+    :param preferred: The rate the audio is needed at.
+    :type preferred: int
+    :return: The preferred rate if the device supports it, otherwise the device's default rate.
+    :rtype: int
+    """
+    device_info = p.get_default_input_device_info()
+    try:
+        if p.is_format_supported(preferred, input_device=device_info["index"], input_channels=1,
+                                 input_format=paInt16):
+            return preferred
+    except ValueError:
+        pass
+    return int(device_info["defaultSampleRate"])
@@ -0,0 +1,324 @@
+import time
+from math import gcd
+
+from numpy import ndarray, arange, concatenate, zeros, sinc, kaiser, clip, rint, einsum, float32, int16, sqrt, mean, \
+    square, sin, cos, pi, flatnonzero, newaxis
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Configuration
+resampler_half_width = 16  # Zero crossings of the sinc kept on each side, more is sharper but slower
+resampler_beta = 8.6  # Kaiser window shape, trades stop band attenuation for transition width
+resampler_rolloff = 0.95  # Cutoff as a fraction of the lower Nyquist frequency
+pause_threshold = 1000 / 32768  # RMS below which fade_out_at_pause treats a window as a pause
+
+
+class Resampler:
+    """
+    A streaming polyphase resampler with a Kaiser windowed sinc filter.
+
+    The rate change is reduced to up / down. The filter is split into up phases so each output sample is one short
+    dot product with the input history, and every chunk is processed as a single vectorized operation. State is kept
+    between calls so a stream can be resampled chunk by chunk without clicks at the chunk edges.
+
+    :param input_rate: The sample rate of the incoming audio.
+    :type input_rate: int
+    :param output_rate: The sample rate to convert to.
+    :type output_rate: int
+    """
+
+    def __init__(self, input_rate: int, output_rate: int) -> None:
+        """
+        Design the filter and clear the history.
+
+        :param input_rate: The sample rate of the incoming audio.
+        :type input_rate: int
+        :param output_rate: The sample rate to convert to.
+        :type output_rate: int
+        """
+        self.input_rate = int(input_rate)
+        self.output_rate = int(output_rate)
+        divisor = gcd(self.input_rate, self.output_rate)
+        self.up = self.output_rate // divisor
+        self.down = self.input_rate // divisor
+
+        factor = max(self.up, self.down)
+        cutoff = 0.5 * resampler_rolloff / factor
+        n = arange(-resampler_half_width * factor, resampler_half_width * factor + 1)
+        taps = 2 * cutoff * sinc(2 * cutoff * n) * kaiser(len(n), resampler_beta) * self.up
+        padded = zeros(-(-len(taps) // self.up) * self.up)
+        padded[:len(taps)] = taps
+        # Row p holds the taps used by phase p, reversed so they line up with a forward window of the input
+        self.phases = padded.reshape(-1, self.up).T[:, ::-1].astype(float32)
+        self.taps = self.phases.shape[1]
+        self.delay = (len(taps) - 1) // 2
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Clear the input history so the next chunk is treated as the start of a new stream.
+        """
+        self.history = zeros(self.taps - 1, dtype=float32)
+        self.position = (self.taps - 1) * self.up
+
+    def process(self, samples: ndarray) -> ndarray:
+        """
+        Resample the next chunk of a stream.
+
+        :param samples: Mono samples, int16 or float.
+        :type samples: numpy.ndarray
+        :return: The resampled chunk in the same type as the input.
+        :rtype: numpy.ndarray
+        """
+        if self.up == self.down or len(samples) == 0:
+            return samples
+        buffer = concatenate((self.history, samples.astype(float32, copy=False)))
+        last = len(buffer) * self.up - 1
+        count = max(0, (last - self.position) // self.down + 1)
+        positions = self.position + arange(count) * self.down
+        windows = sliding_window_view(buffer, self.taps)
+        output = einsum("ij,ij->i", windows[positions // self.up - self.taps + 1], self.phases[positions % self.up])
+
+        self.position += count * self.down - (len(buffer) - self.taps + 1) * self.up
+        self.history = buffer[len(buffer) - self.taps + 1:]
+        if samples.dtype == int16:
+            return clip(rint(output), -32768, 32767).astype(int16)
+        return output.astype(samples.dtype, copy=False)
+
+    def output_length(self, input_length: int) -> int:
+        """
+        Get the number of samples a clip of the given length resamples to.
+
+        :param input_length: The number of input samples.
+        :type input_length: int
+        :return: The number of output samples.
+        :rtype: int
+        """
+        return -(-input_length * self.up // self.down)
+
+
+def resample(samples: ndarray, input_rate: int, output_rate: int) -> ndarray:
+    """
+    Resample a whole clip, compensating for the filter delay so the output lines up with the input.
+
+    :param samples: Mono samples, int16 or float.
+    :type samples: numpy.ndarray
+    :param input_rate: The sample rate of the clip.
+    :type input_rate: int
+    :param output_rate: The sample rate to convert to.
+    :type output_rate: int
+    :return: The resampled clip in the same type as the input.
+    :rtype: numpy.ndarray
+    """
+    if input_rate == output_rate:
+        return samples
+    resampler = Resampler(input_rate, output_rate)
+    # Start part way into the first output period so whole outputs can be dropped to cancel the filter delay
+    resampler.position += resampler.delay % resampler.down
+    skip = resampler.delay // resampler.down
+    padding = zeros(-(-resampler.delay // resampler.up) + 1, dtype=samples.dtype)
+    output = resampler.process(concatenate((samples, padding)))
+    return output[skip:skip + resampler.output_length(len(samples))]
+
+
+def to_float(samples: ndarray) -> ndarray:
+    """
+    Convert int16 samples to float32 between -1 and 1.
+
+    :param samples: int16 samples.
+    :type samples: numpy.ndarray
+    :return: float32 samples.
+    :rtype: numpy.ndarray
+    """
+    return samples.astype(float32) * (1 / 32768)
+
+
+def to_int16(samples: ndarray) -> ndarray:
+    """
+    Convert float samples between -1 and 1 to int16, clipping anything outside that range.
+
+    :param samples: Float samples.
+    :type samples: numpy.ndarray
+    :return: int16 samples.
+    :rtype: numpy.ndarray
+    """
+    return clip(rint(samples * 32768), -32768, 32767).astype(int16)
+
+
+def windowed_rms(samples: ndarray, window: int) -> ndarray:
+    """
+    Get the RMS level of every whole window of a clip at once.
+
+    :param samples: Float samples, shaped (frames,) or (frames, channels).
+    :type samples: numpy.ndarray
+    :param window: The number of frames per window.
+    :type window: int
+    :return: One RMS value per window, a trailing partial window is ignored.
+    :rtype: numpy.ndarray
+    """
+    count = len(samples) // window
+    windows = samples[:count * window].reshape(count, -1)
+    return sqrt(mean(square(windows, dtype=float32), axis=1))
+
+
+def linear_ramp(start: float, end: float, length: int, count: int = None) -> ndarray:
+    """
+    Get gains moving in a straight line from start to end over length samples.
+
+    The first value is one step past start and the last of a full ramp is exactly end, so consecutive ramps and
+    partial ramps continued in the next buffer join without a repeated or skipped step.
+
+    :param start: The gain before the ramp.
+    :type start: float
+    :param end: The gain at the end of the ramp.
+    :type end: float
+    :param length: The length of the whole ramp in samples.
+    :type length: int
+    :param count: How many of the ramp's gains to return, the whole ramp if not given.
+    :type count: int, optional
+    :return: float32 gains.
+    :rtype: numpy.ndarray
+    """
+    count = length if count is None else count
+    return (start + (end - start) * arange(1, count + 1, dtype=float32) / length).astype(float32)
+
+
+def equal_power_ramps(length: int) -> tuple:
+    """
+    Get the fade out and fade in gains of an equal power crossfade, which keeps the loudness steady throughout.
+
+    :param length: The length of the crossfade in samples.
+    :type length: int
+    :return: The outgoing gains and the incoming gains.
+    :rtype: tuple
+    """
+    angle = (arange(length, dtype=float32) + 0.5) * (pi / 2 / length)
+    return cos(angle).astype(float32), sin(angle).astype(float32)
+
+
+def apply_gain(samples: ndarray, gains: ndarray) -> ndarray:
+    """
+    Multiply every frame by its own gain.
+
+    :param samples: Float samples, shaped (frames,) or (frames, channels).
+    :type samples: numpy.ndarray
+    :param gains: One gain per frame.
+    :type gains: numpy.ndarray
+    :return: The scaled samples.
+    :rtype: numpy.ndarray
+    """
+    return samples * (gains if samples.ndim == 1 else gains[:, newaxis])
+
+
+def fade_out(samples: ndarray, length: int) -> ndarray:
+    """
+    Fade the end of a clip out to silence.
+
+    :param samples: Float samples, shaped (frames,) or (frames, channels).
+    :type samples: numpy.ndarray
+    :param length: The length of the fade in samples.
+    :type length: int
+    :return: A faded copy of the clip.
+    :rtype: numpy.ndarray
+    """
+    faded = samples.astype(float32)
+    length = min(length, len(faded))
+    if length:
+        faded[len(faded) - length:] = apply_gain(faded[len(faded) - length:], linear_ramp(1.0, 0.0, length))
+    return faded
+
+
+def fade_out_at_pause(samples: ndarray, window: int, threshold: float = pause_threshold) -> ndarray:
+    """
+    Fade a clip out from its first quiet window, so a cut lands in a pause rather than in the middle of a word.
+
+    :param samples: Float samples, shaped (frames,) or (frames, channels).
+    :type samples: numpy.ndarray
+    :param window: The number of frames per window checked for quiet.
+    :type window: int
+    :param threshold: The RMS below which a window counts as quiet.
+    :type threshold: float
+    :return: A copy of the clip that is silent from the end of the fade.
+    :rtype: numpy.ndarray
+    """
+    quiet = flatnonzero(windowed_rms(samples, window) < threshold)
+    start = int(quiet[0]) * window if len(quiet) else 0
+    faded = fade_out(samples[:start + window], min(window, len(samples) - start))
+    silence = zeros((len(samples) - len(faded),) + samples.shape[1:], dtype=float32)
+    return concatenate((faded, silence))
+
+
+def benchmark_fades(seconds: float = 0.5, rate: int = 24000, repeats: int = 1000) -> dict:
+    """
+    Time the fade stages on one mixer sized chunk of audio.
+
+    :param seconds: The length of the chunk.
+    :type seconds: float
+    :param rate: The sample rate of the chunk.
+    :type rate: int
+    :param repeats: How many times to run each stage.
+    :type repeats: int
+    :return: Microseconds per call for each stage.
+    :rtype: dict
+    """
+    from numpy.random import default_rng
+
+    samples = to_float(default_rng(0).integers(-8000, 8000, int(rate * seconds), dtype=int16))
+    stages = {"windowed_rms": lambda: windowed_rms(samples, 400),
+              "fade_out": lambda: fade_out(samples, 400),
+              "fade_out_at_pause": lambda: fade_out_at_pause(samples, 400),
+              "equal_power_ramps": lambda: equal_power_ramps(2400)}
+    results = {}
+    for name, stage in stages.items():
+        start = time.perf_counter()
+        for _ in range(repeats):
+            stage()
+        results[name] = (time.perf_counter() - start) / repeats * 1e6
+    return results
+
+
+def benchmark(input_rate: int = 44100, output_rate: int = 16000, seconds: float = 10.0, chunk: int = 2048) -> dict:
+    """
+    Compare the throughput of the streaming resampler with audioop.ratecv on random audio.
+
+    :param input_rate: The rate to convert from.
+    :type input_rate: int
+    :param output_rate: The rate to convert to.
+    :type output_rate: int
+    :param seconds: The length of the test signal.
+    :type seconds: float
+    :param chunk: The number of samples per call, matching a microphone read.
+    :type chunk: int
+    :return: Seconds of audio processed per second of CPU for each resampler.
+    :rtype: dict
+    """
+    from numpy.random import default_rng
+
+    samples = default_rng(0).integers(-8000, 8000, int(input_rate * seconds), dtype=int16)
+    chunks = [samples[i:i + chunk] for i in range(0, len(samples), chunk)]
+    results = {}
+
+    resampler = Resampler(input_rate, output_rate)
+    start = time.perf_counter()
+    for piece in chunks:
+        resampler.process(piece)
+    results["polyphase"] = seconds / (time.perf_counter() - start)
+
+    try:
+        import audioop
+    except ImportError:
+        return results
+    state = None
+    byte_chunks = [piece.tobytes() for piece in chunks]
+    start = time.perf_counter()
+    for piece in byte_chunks:
+        _, state = audioop.ratecv(piece, 2, 1, input_rate, output_rate, state)
+    results["audioop.ratecv"] = seconds / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == "__main__":
+    for rate in (44100, 48000):
+        for name, speed in benchmark(input_rate=rate).items():
+            print(f"{rate} -> 16000 | {name:>15} | {speed:8.1f}x real time")
+    for name, microseconds in benchmark_fades().items():
+        print(f"{name:>17} | {microseconds:8.1f} us per 0.5 s chunk")
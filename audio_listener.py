@@ -1,33 +1,41 @@
-import sys
-import time
 import os
 import wave
+import datetime
 import certifi
-import audioop
 from io import BytesIO
+from typing import Optional, Union
 from soundfile import read
-from numpy import float32
-from numpy import frombuffer, int16, average
-from pyaudio import PyAudio, paInt16, get_sample_size
-import whisper
-from torch.cuda import is_available
+from numpy import ndarray, float32, int16, clip
+from pyaudio import paInt16, get_sample_size
 
 import logger_config
+from audio_capture import CaptureBuffer, NoiseFloorTracker, chunk_rms
+from audio_dsp import Resampler
+from endpointing import make_endpointer
+from mic_service import subscribe
+from speech_model import manager
+from streaming_transcription import StreamingTranscriber
 
 logger = logger_config.get_logger()
 
 os.environ["REQUESTS_CA_BUNDLE"] = certifi.where()
 os.environ["SSL_CERT_FILE"] = certifi.where()
 
-# Initialize the speech recognition module and microphone
-paudio = PyAudio()
-device_info = paudio.get_default_input_device_info()
-paudio.terminate()
-default_sample_rate = int(device_info["defaultSampleRate"])
+# Initialize the speech recognition module
+whisper_sample_rate = 16000
 default_sample_width = get_sample_size(paInt16)
 current_energy_threshold = 300
 dynamic_energy_adjustment_damping = 0.15
 dynamic_energy_ratio = 1.5
+streaming_transcription = True
+endpointing = "adaptive"  # One of endpointing.endpointers, "fixed" restores the 3 s minimum / 2.5 s silence rule
+archive_path = None  # Set to a folder to keep a WAV copy of every query
+trim_silence = True  # Drop the audio before the first and after the last speech so it is never transcribed
+trim_guard_seconds = 0.3  # Audio kept around the speech so soft word edges survive the trim
+preroll_seconds = 0.3  # Standby audio prepended to a query when there is no wake word position to carry on from
+noise_floor_rise_damping = 0.97  # Fraction of the threshold kept per second while the standby audio gets louder
+noise_floor = NoiseFloorTracker(current_energy_threshold, ratio=dynamic_energy_ratio,
+                                fall_damping=dynamic_energy_adjustment_damping, rise_damping=noise_floor_rise_damping)
 
 
 def prep_mic(duration: float = 1.0) -> None:
@@ -40,15 +48,10 @@ def prep_mic(duration: float = 1.0) -> None:
     """
     global current_energy_threshold
     chunk = 1024
-    seconds_per_buffer = (chunk + 0.0) / default_sample_rate
     elapsed_time = 0
 
-    p = PyAudio()
-    stream = p.open(format=paInt16,
-                    channels=1,
-                    rate=default_sample_rate,
-                    input=True,
-                    frames_per_buffer=chunk)
+    stream = subscribe()
+    seconds_per_buffer = (chunk + 0.0) / stream.sample_rate
 
     # adjust energy threshold until a phrase starts
     while True:
@@ -56,120 +59,188 @@ def prep_mic(duration: float = 1.0) -> None:
         if elapsed_time > duration:
             break
         buffer = stream.read(chunk)
-        energy = audioop.rms(buffer, default_sample_width)  # energy of the audio signal
+        energy = chunk_rms(buffer)  # energy of the audio signal
 
         # dynamically adjust the energy threshold using asymmetric weighted average
         damping = dynamic_energy_adjustment_damping ** seconds_per_buffer
         # account for different chunk sizes and rates
         target_energy = energy * dynamic_energy_ratio
         current_energy_threshold = current_energy_threshold * damping + target_energy * (1 - damping)
-    p.terminate()
+    stream.close()
     logger.info("Microphone adjusted for ambient noise.")
 
 
-def listen_to_user() -> BytesIO:
+def track_ambient_noise(samples, sample_rate: int = 16000) -> None:
     """
-    Listen to the user and record their speech, stopping when there's silence.
+    Keep the energy threshold up to date from audio heard while waiting for the wake word.
 
-    :return: The recorded audio data.
-    :rtype: BytesIO
+    :param samples: int16 samples, as an array or any sequence.
+    :type samples: numpy.ndarray or tuple
+    :param sample_rate: The sample rate of the samples.
+    :type sample_rate: int
+    :return: None
+    """
+    global current_energy_threshold
+    noise_floor.threshold = current_energy_threshold
+    current_energy_threshold = noise_floor.update(samples, sample_rate)
+
+
+def listen_to_user(transcriber: Optional[StreamingTranscriber] = None, start_position: Optional[int] = None) -> ndarray:
+    """
+    Listen to the user and record their speech, stopping when the configured endpointer decides they are done.
+
+    Recording starts at start_position in the shared microphone, normally where the wake word stream stopped, so
+    nothing said right after the wake word is lost. Without a position the last preroll_seconds of standby audio are
+    prepended instead.
+
+    Silence before the first and after the last speech the endpointer heard is trimmed, keeping trim_guard_seconds
+    on both sides, so neither mode spends decode time on dead audio.
+
+    Audio comes from the shared microphone, which already runs at 16 kHz, so the polyphase resampler only does
+    work if that ever changes. Each chunk is converted to 16 kHz float32 as it is captured, so the returned recording can be passed straight to
+    convert_to_text. If a transcriber is given the audio is also fed to it while recording, and its tail is handed
+    off as soon as the silence is detected.
+
+    :param transcriber: A streaming transcriber to feed while recording.
+    :type transcriber: StreamingTranscriber, optional
+    :param start_position: The shared microphone position to start recording from.
+    :type start_position: int, optional
+    :return: The recorded audio as float32 samples at 16 kHz.
+    :rtype: numpy.ndarray
     """
-    # Initialize PyAudio and create a stream
-    p = PyAudio()
-    stream = p.open(format=paInt16,
-                    channels=1,
-                    rate=default_sample_rate,
-                    input=True,
-                    frames_per_buffer=2048)
-
-    audio_data = b''
-    window_size = 10
-    volume_buffer = []
-    silence_duration = 0
-    silence_threshold = 2.5
-    start = time.time()
+    # Subscribe to the shared microphone and go back to the end of the wake word, or by the pre-roll
+    stream = subscribe()
+    if start_position is not None:
+        stream.seek(start_position)
+    else:
+        stream.rewind(int(preroll_seconds * stream.sample_rate))
+
+    recording = CaptureBuffer(whisper_sample_rate, sample_type=float32)
+    endpointer = make_endpointer(endpointing, stream.sample_rate)
+    resampler = Resampler(stream.sample_rate, whisper_sample_rate)
 
     logger.info("Listening to user...")
 
+    fed = None
     while True:
         # Read a chunk of audio data from the stream
-        chunk = stream.read(2048)
-        audio_data += chunk
-
-        # Calculate the volume of the audio data in the chunk
-        volume = frombuffer(chunk, dtype=int16)
-        volume_buffer.append(average(abs(volume)))
-
-        # Keep track of the average volume over the last window_size chunks
-        if len(volume_buffer) > window_size:
-            volume_buffer.pop(0)
-        avg_volume = average(volume_buffer)
-
-        # Keep track of the duration of silence
-        if avg_volume < current_energy_threshold and time.time() - start > 3:
-            silence_duration += len(chunk) / default_sample_rate
-        else:
-            silence_duration = 0
-
-        # Stop recording if there is enough silence
-        if silence_duration > silence_threshold:
+        samples = stream.read(2048)
+        recording.append(resampler.process(samples))
+        finished = endpointer.process(samples, current_energy_threshold)
+
+        # Feed the transcriber from just before the first speech so leading silence is never decoded
+        if transcriber is not None:
+            if fed is None and (endpointer.speech_start is not None or not trim_silence):
+                fed = (endpointer.speech_bounds(whisper_sample_rate, trim_guard_seconds) or (0, 0))[0]
+            if fed is not None:
+                transcriber.feed(recording.view()[fed:])
+                fed = recording.length
+                endpointer.update_transcript(transcriber.partial_text())
+
+        # Stop recording once the endpointer decides the user has finished
+        if finished:
             break
 
-    # Close the stream and terminate PyAudio
-    stream.stop_stream()
-    stream.close()
-    p.terminate()
+    # Work out where the speech is so the dead audio around it can be dropped
+    audio = recording.view()
+    bounds = endpointer.speech_bounds(whisper_sample_rate, trim_guard_seconds) if trim_silence else None
+    start, end = bounds or (0, len(audio))
+
+    # Hand the tail to the transcriber before anything else
+    if transcriber is not None:
+        if fed is None:
+            transcriber.feed(audio)
+            fed = len(audio)
+        transcriber.finish(trailing_silence=max(0, fed - end))
 
-    logger.info("Finished listening to user.")
+    # Detach from the shared microphone
+    stream.close()
 
-    # Create an AudioData object from the recorded audio data
+    logger.info(f"Finished listening to user, kept {(end - start) / whisper_sample_rate:.2f}s of "
+                f"{len(audio) / whisper_sample_rate:.2f}s.")
+    if archive_path is not None:
+        path = os.path.join(archive_path, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".wav")
+        save_wav(audio, path)
+        logger.info(f"Saved query audio to {path}")
+    audio = audio[start:end]
+    return audio
 
-    # Fix this
-    sample_rate = default_sample_rate
-    sample_width = default_sample_width
-    convert_rate = 16000
 
-    if sample_rate != convert_rate:
-        audio_data, _ = audioop.ratecv(audio_data, sample_width, 1, sample_rate, convert_rate, None)
+def to_wav(audio: ndarray, sample_rate: int = 16000) -> BytesIO:
+    """
+    Encode float32 audio as a 16-bit WAV file in memory.
 
+    :param audio: float32 samples between -1 and 1.
+    :type audio: numpy.ndarray
+    :param sample_rate: The sample rate of the audio.
+    :type sample_rate: int
+    :return: The WAV file contents, rewound to the start.
+    :rtype: BytesIO
+    """
     wave_file_data = BytesIO()
-    # generate the WAV file contents
-    wav_writer = wave.open(wave_file_data, "wb")
-    try:  # note that we can't use context manager, since that was only added in Python 3.4
+    with wave.open(wave_file_data, "wb") as wav_writer:
         wav_writer.setframerate(sample_rate)
-        wav_writer.setsampwidth(sample_width)
+        wav_writer.setsampwidth(default_sample_width)
         wav_writer.setnchannels(1)
-        wav_writer.writeframes(audio_data)
-        wave_file_data.seek(0)
-    except Exception as e:
-        # make sure resources are cleaned up
-        logger.error(e)
-        wav_writer.close()
+        wav_writer.writeframes((clip(audio, -1, 1) * 32767).astype(int16).tobytes())
+    wave_file_data.seek(0)
     return wave_file_data
 
 
-def convert_to_text(audio: BytesIO) -> str:
+def save_wav(audio: ndarray, path: str, sample_rate: int = 16000) -> None:
+    """
+    Save float32 audio as a 16-bit WAV file, for debugging or archiving queries.
+
+    :param audio: float32 samples between -1 and 1.
+    :type audio: numpy.ndarray
+    :param path: The path of the file to write.
+    :type path: str
+    :param sample_rate: The sample rate of the audio.
+    :type sample_rate: int
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(path, "wb") as file:
+        file.write(to_wav(audio, sample_rate).getbuffer())
+
+
+def start_streaming_transcription() -> Optional[StreamingTranscriber]:
+    """
+    Create a streaming transcriber for the next call to listen_to_user if streaming transcription is enabled.
+
+    :return: A new streaming transcriber, or None if streaming transcription is disabled.
+    :rtype: StreamingTranscriber or None
+    """
+    if streaming_transcription:
+        return StreamingTranscriber()
+    return None
+
+
+def convert_to_text(audio: Union[ndarray, BytesIO, str]) -> str:
     """
     Convert the given audio data to text using speech recognition.
 
-    :param audio: The audio data to convert.
-    :type audio: BytesIO
+    :param audio: float32 samples at 16 kHz, or a 16 kHz audio file or file-like object.
+    :type audio: numpy.ndarray or BytesIO or str
     :return: str, the recognized text from the audio
     :rtype: str
     """
     logger.info("Converting audio to text...")
-    dir_path = "whisper_models"
-    if getattr(sys, 'frozen', False):
-        dir_path = os.path.join(sys._MEIPASS, "whisper_models")
-    model = whisper.load_model("base.en", download_root=dir_path)
-    array_audio, sampling_rate = read(audio)
-    array_audio = array_audio.astype(float32)
-    result = model.transcribe(array_audio, fp16=is_available())
-    return result["text"]
+    if isinstance(audio, ndarray):
+        array_audio = audio
+    else:
+        array_audio, sampling_rate = read(audio, dtype="float32")
+    with manager.use() as model:
+        return model.transcribe(array_audio)
 
 
 if __name__ == "__main__":
     prep_mic()
-    audio_test = listen_to_user()
-    text = convert_to_text(audio_test)
+    transcriber_test = start_streaming_transcription()
+    audio_test = listen_to_user(transcriber=transcriber_test)
+    if transcriber_test is not None:
+        text = transcriber_test.result()
+    else:
+        text = convert_to_text(audio_test)
     print(text)
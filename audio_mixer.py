@@ -0,0 +1,662 @@
+import argparse
+import atexit
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from numpy import ndarray, arange, concatenate, empty, float32, frombuffer, int16, newaxis, repeat, rint, zeros, \
+    flatnonzero, median, percentile, sin, pi
+from pyaudio import PyAudio, paInt16, paContinue
+
+from audio_dsp import Resampler, resample, to_float, to_int16, linear_ramp, equal_power_ramps, apply_gain, \
+    fade_out_at_pause
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+# Configuration
+mixer_rate = 24000  # The rate of the cues and of the text to speech voices, so most sources need no resampling
+mixer_channels = 1  # Voices are mono, the stereo cues (beeps.wav, searching.wav) are mixed down on load
+mixer_frames = 480  # Frames per device callback, 20 ms, which bounds how long a stop takes to be heard
+default_fade_seconds = 0.01  # Used when a sound is stopped, fits inside one buffer but is long enough not to click
+stop_pause_seconds = 0.1  # How far a skip may look ahead for a pause to end on, it never plays past this
+
+
+def to_mixer_samples(samples: ndarray, channels: int, rate: int) -> ndarray:
+    """
+    Convert interleaved int16 audio to the mixer's rate and channel layout.
+
+    :param samples: Interleaved int16 samples.
+    :type samples: numpy.ndarray
+    :param channels: The number of interleaved channels.
+    :type channels: int
+    :param rate: The sample rate of the audio.
+    :type rate: int
+    :return: int16 samples shaped (frames, mixer_channels) at mixer_rate.
+    :rtype: numpy.ndarray
+    """
+    frames = samples.reshape(-1, channels)
+    if channels != mixer_channels:
+        mono = rint(frames.mean(axis=1)).astype(int16) if channels > 1 else frames[:, 0]
+        frames = repeat(mono[:, newaxis], mixer_channels, axis=1)
+    if rate != mixer_rate:
+        frames = concatenate([resample(frames[:, channel].copy(), rate, mixer_rate)[:, newaxis]
+                              for channel in range(mixer_channels)], axis=1)
+    return frames
+
+
+class Sound:
+    """
+    A handle to one source playing in the mixer.
+
+    The handle can change the source's volume smoothly, stop it with a short fade and wait for it to finish. The
+    fade is applied by the mixer's callback, so the change is heard within one device buffer. Events passed to
+    stop_on are checked by the callback itself, so a skip is honoured without waiting for any other thread, and the
+    skip fades out at the first pause within stop_pause_seconds so a word is not cut in half.
+
+    :param gain: The starting volume, 1 for full volume.
+    :type gain: float
+    """
+
+    def __init__(self, gain: float = 1.0) -> None:
+        """
+        Initialize the handle.
+
+        :param gain: The starting volume, 1 for full volume.
+        :type gain: float
+        """
+        self.gain = gain
+        self.target_gain = gain
+        self.fade_left = 0
+        self.fade_start = gain
+        self.fade_curve = None
+        self.stopping = False
+        self.tail = None
+        self.request = None
+        self.stop_events = []
+        self.finished = threading.Event()
+
+    def fade_to(self, gain: float, seconds: float, curve: Optional[ndarray] = None) -> None:
+        """
+        Move the volume to a new level over a number of seconds.
+
+        :param gain: The volume to end at.
+        :type gain: float
+        :param seconds: The length of the fade, ignored if a curve is given.
+        :type seconds: float
+        :param curve: Gains rising from 0 to 1, one per frame, that shape the fade, a straight line if not given.
+        :type curve: numpy.ndarray, optional
+        """
+        length = len(curve) if curve is not None else max(1, int(seconds * mixer_rate))
+        self.request = (gain, length, False, curve, False)
+
+    def stop(self, fade: float = default_fade_seconds, curve: Optional[ndarray] = None,
+             at_pause: bool = False) -> None:
+        """
+        Fade the sound out and remove it from the mixer.
+
+        :param fade: The length of the fade out in seconds, 0 to cut immediately, ignored if a curve is given.
+        :type fade: float
+        :param curve: Gains rising from 0 to 1, one per frame, that shape the fade, a straight line if not given.
+        :type curve: numpy.ndarray, optional
+        :param at_pause: Play on to the first pause within stop_pause_seconds and fade out there.
+        :type at_pause: bool
+        """
+        if fade <= 0 and curve is None:
+            self.finished.set()
+        else:
+            length = len(curve) if curve is not None else max(1, int(fade * mixer_rate))
+            self.request = (0.0, length, True, curve, at_pause)
+
+    def stop_on(self, *events) -> "Sound":
+        """
+        Stop the sound as soon as any of the events is set.
+
+        :param events: threading or multiprocessing events, None entries are ignored.
+        :type events: threading.Event
+        :return: The same sound.
+        :rtype: Sound
+        """
+        self.stop_events.extend(event for event in events if event is not None)
+        return self
+
+    def done(self) -> bool:
+        """
+        Check whether the sound has finished or been stopped.
+
+        :return: True if nothing more will be heard from this sound.
+        :rtype: bool
+        """
+        return self.finished.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the sound to finish.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float, optional
+        :return: True if the sound has finished.
+        :rtype: bool
+        """
+        return self.finished.wait(timeout)
+
+    def read(self, frames: int) -> ndarray:
+        """
+        Get the next frames of the source, called from the mixer callback.
+
+        :param frames: The number of frames wanted.
+        :type frames: int
+        :return: Up to frames int16 frames shaped (frames, mixer_channels).
+        :rtype: numpy.ndarray
+        """
+        raise NotImplementedError
+
+    def exhausted(self) -> bool:
+        """
+        Check whether the source has nothing left to play.
+
+        :return: True if the source has ended.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def render(self, frames: int) -> ndarray:
+        """
+        Get the next frames with the volume envelope applied, called from the mixer callback.
+
+        :param frames: The number of frames wanted.
+        :type frames: int
+        :return: Up to frames float32 frames.
+        :rtype: numpy.ndarray
+        """
+        if not self.stopping and any(event.is_set() for event in self.stop_events):
+            self.stop(at_pause=True)
+        request, self.request = self.request, None
+        if request is not None and self.tail is None:
+            self.target_gain, self.fade_left, stopping, self.fade_curve, at_pause = request
+            self.fade_start = self.gain
+            self.stopping = self.stopping or stopping
+            if at_pause:
+                self.tail = self._pause_tail(self.fade_left)
+                self.fade_left = 0
+
+        # A sound stopped at a pause only plays out the tail it has already faded
+        if self.tail is not None:
+            block, self.tail = self.tail[:frames], self.tail[frames:]
+            if not len(self.tail):
+                self.finished.set()
+            return block * self.gain if self.gain != 1.0 else block
+
+        block = to_float(self.read(frames))
+        count = len(block)
+        if self.fade_left > 0 and count:
+            steps = min(count, self.fade_left)
+            envelope = empty(count, dtype=float32)
+            if self.fade_curve is None:
+                envelope[:steps] = linear_ramp(self.gain, self.target_gain, self.fade_left, steps)
+            else:
+                done = len(self.fade_curve) - self.fade_left
+                envelope[:steps] = self.fade_start + (self.target_gain - self.fade_start) * \
+                    self.fade_curve[done:done + steps]
+            self.fade_left -= steps
+            self.gain = self.target_gain if self.fade_left == 0 else float(envelope[steps - 1])
+            envelope[steps:] = self.gain
+            block = apply_gain(block, envelope)
+        elif self.gain != 1.0:
+            block *= self.gain
+
+        if (self.stopping and self.fade_left == 0) or self.exhausted():
+            self.finished.set()
+        return block
+
+    def _pause_tail(self, fade: int) -> ndarray:
+        """
+        Read ahead up to stop_pause_seconds and fade it out from the first pause, called from the mixer callback.
+
+        :param fade: The length of the fade out in frames, also the window checked for a pause.
+        :type fade: int
+        :return: The float32 frames left to play, ending in silence.
+        :rtype: numpy.ndarray
+        """
+        ahead = to_float(self.read(max(fade, int(stop_pause_seconds * mixer_rate))))
+        faded = fade_out_at_pause(ahead, fade)
+        audible = flatnonzero(faded.any(axis=1))
+        return faded[:audible[-1] + 1] if len(audible) else faded[:0]
+
+
+class BufferSound(Sound):
+    """
+    A sound held entirely in memory, played a number of times back to back without a gap.
+
+    :param samples: int16 samples shaped (frames, mixer_channels) at mixer_rate.
+    :type samples: numpy.ndarray
+    :param loops: The number of times to play it, None to loop until stopped.
+    :type loops: int, optional
+    :param gain: The starting volume.
+    :type gain: float
+    """
+
+    def __init__(self, samples: ndarray, loops: Optional[int] = 1, gain: float = 1.0) -> None:
+        """
+        Initialize the sound.
+
+        :param samples: int16 samples shaped (frames, mixer_channels) at mixer_rate.
+        :type samples: numpy.ndarray
+        :param loops: The number of times to play it, None to loop until stopped.
+        :type loops: int, optional
+        :param gain: The starting volume.
+        :type gain: float
+        """
+        super().__init__(gain)
+        self.samples = samples
+        self.loops = loops
+        self.loop = 0
+        self.position = 0
+        self.ended = len(samples) == 0 or loops == 0
+
+    def read(self, frames: int) -> ndarray:
+        """
+        Get the next frames, wrapping to the start for every loop.
+
+        :param frames: The number of frames wanted.
+        :type frames: int
+        :return: Up to frames int16 frames.
+        :rtype: numpy.ndarray
+        """
+        parts = []
+        needed = frames
+        while needed and not self.ended:
+            take = min(needed, len(self.samples) - self.position)
+            parts.append(self.samples[self.position:self.position + take])
+            self.position += take
+            needed -= take
+            if self.position == len(self.samples):
+                self.position = 0
+                self.loop += 1
+                self.ended = self.loops is not None and self.loop >= self.loops
+        if not parts:
+            return empty((0, mixer_channels), dtype=int16)
+        return parts[0] if len(parts) == 1 else concatenate(parts)
+
+    def exhausted(self) -> bool:
+        """
+        Check whether every loop has been played.
+
+        :return: True if the sound has ended.
+        :rtype: bool
+        """
+        return self.ended
+
+
+class StreamSound(Sound):
+    """
+    A sound fed while it plays, for audio that is still being generated such as text to speech.
+
+    Chunks written at any rate are converted to the mixer's format as they arrive. If playback catches up with the
+    writer the mixer plays silence for this sound until more arrives, and the sound only ends once it is closed
+    and drained.
+
+    :param rate: The sample rate of the chunks that will be written.
+    :type rate: int
+    :param channels: The number of interleaved channels in the chunks.
+    :type channels: int
+    :param gain: The starting volume.
+    :type gain: float
+    """
+
+    def __init__(self, rate: int, channels: int = 1, gain: float = 1.0) -> None:
+        """
+        Initialize the sound.
+
+        :param rate: The sample rate of the chunks that will be written.
+        :type rate: int
+        :param channels: The number of interleaved channels in the chunks.
+        :type channels: int
+        :param gain: The starting volume.
+        :type gain: float
+        """
+        super().__init__(gain)
+        self.rate = rate
+        self.channels = channels
+        self.resamplers = [Resampler(rate, mixer_rate) for _ in range(mixer_channels)]
+        self.blocks = deque()
+        self.closed = False
+
+    def write(self, samples) -> None:
+        """
+        Queue more audio.
+
+        :param samples: Interleaved int16 samples, as an array or raw bytes.
+        :type samples: numpy.ndarray or bytes
+        """
+        if isinstance(samples, (bytes, bytearray)):
+            samples = frombuffer(samples, dtype=int16)
+        if len(samples) == 0:
+            return
+        frames = samples.reshape(-1, self.channels)
+        if self.channels != mixer_channels:
+            mono = rint(frames.mean(axis=1)).astype(int16) if self.channels > 1 else frames[:, 0]
+            frames = repeat(mono[:, newaxis], mixer_channels, axis=1)
+        if self.rate != mixer_rate:
+            frames = concatenate([self.resamplers[channel].process(frames[:, channel].copy())[:, newaxis]
+                                  for channel in range(mixer_channels)], axis=1)
+        self.blocks.append(frames)
+
+    def close(self) -> None:
+        """
+        Mark the end of the audio, the sound finishes once everything written has played.
+        """
+        self.closed = True
+
+    def pending(self) -> int:
+        """
+        Get the number of frames written but not played yet.
+
+        :return: The number of frames.
+        :rtype: int
+        """
+        return sum(len(block) for block in list(self.blocks))
+
+    def read(self, frames: int) -> ndarray:
+        """
+        Get the next frames that have been written.
+
+        :param frames: The number of frames wanted.
+        :type frames: int
+        :return: Up to frames int16 frames.
+        :rtype: numpy.ndarray
+        """
+        parts = []
+        needed = frames
+        while needed and self.blocks:
+            block = self.blocks[0]
+            if len(block) <= needed:
+                parts.append(self.blocks.popleft())
+                needed -= len(block)
+            else:
+                parts.append(block[:needed])
+                self.blocks[0] = block[needed:]
+                needed = 0
+        if not parts:
+            return empty((0, mixer_channels), dtype=int16)
+        return parts[0] if len(parts) == 1 else concatenate(parts)
+
+    def exhausted(self) -> bool:
+        """
+        Check whether the sound has been closed and fully played.
+
+        :return: True if the sound has ended.
+        :rtype: bool
+        """
+        return self.closed and not self.blocks
+
+
+class Mixer:
+    """
+    Owns one output stream and mixes every sound playing through it.
+
+    The device is opened once and fed from a callback that sums the active sounds, so starting a sound costs no
+    device open, several sounds can overlap and one can be crossfaded into another without a gap.
+
+    :param rate: The output sample rate.
+    :type rate: int
+    :param channels: The number of output channels.
+    :type channels: int
+    :param frames: The number of frames per device callback.
+    :type frames: int
+    """
+
+    def __init__(self, rate: int = mixer_rate, channels: int = mixer_channels, frames: int = mixer_frames) -> None:
+        """
+        Initialize the mixer without opening the device.
+
+        :param rate: The output sample rate.
+        :type rate: int
+        :param channels: The number of output channels.
+        :type channels: int
+        :param frames: The number of frames per device callback.
+        :type frames: int
+        """
+        self.rate = rate
+        self.channels = channels
+        self.frames = frames
+        self.sounds = []
+        self.lock = threading.Lock()
+        self.p = None
+        self.stream = None
+
+    def start(self) -> None:
+        """
+        Open the output device.
+        """
+        self.p = PyAudio()
+        self.stream = self.p.open(format=paInt16, channels=self.channels, rate=self.rate, output=True,
+                                  frames_per_buffer=self.frames, stream_callback=self._callback)
+        logger.info(f"Output mixer started at {self.rate} Hz, {self.frames} frames per buffer.")
+
+    def add(self, sound: Sound) -> Sound:
+        """
+        Start playing a sound.
+
+        :param sound: The sound to play.
+        :type sound: Sound
+        :return: The same sound, as a handle.
+        :rtype: Sound
+        """
+        with self.lock:
+            self.sounds.append(sound)
+        return sound
+
+    def play(self, samples: ndarray, loops: Optional[int] = 1, gain: float = 1.0) -> BufferSound:
+        """
+        Play audio that is already in memory.
+
+        :param samples: int16 samples shaped (frames, mixer_channels) at mixer_rate, see to_mixer_samples.
+        :type samples: numpy.ndarray
+        :param loops: The number of times to play it, None to loop until stopped.
+        :type loops: int, optional
+        :param gain: The volume.
+        :type gain: float
+        :return: A handle to the sound.
+        :rtype: BufferSound
+        """
+        return self.add(BufferSound(samples, loops, gain))
+
+    def open_stream(self, rate: int, channels: int = 1, gain: float = 1.0) -> StreamSound:
+        """
+        Start a sound that is written while it plays.
+
+        :param rate: The sample rate of the chunks that will be written.
+        :type rate: int
+        :param channels: The number of interleaved channels in the chunks.
+        :type channels: int
+        :param gain: The volume.
+        :type gain: float
+        :return: A handle to write to.
+        :rtype: StreamSound
+        """
+        return self.add(StreamSound(rate, channels, gain))
+
+    def crossfade(self, old: Optional[Sound], new: Sound, seconds: float = 0.1) -> Sound:
+        """
+        Replace one sound with another, fading the first out while the second fades in with equal power gains so
+        the loudness does not dip in the middle.
+
+        :param old: The sound to fade out, if any.
+        :type old: Sound, optional
+        :param new: The sound to fade in, not yet added to the mixer.
+        :type new: Sound
+        :param seconds: The length of the crossfade.
+        :type seconds: float
+        :return: The new sound.
+        :rtype: Sound
+        """
+        falling, rising = equal_power_ramps(max(1, int(seconds * self.rate)))
+        target = new.gain
+        new.gain = 0.0
+        new.fade_to(target, seconds, curve=rising)
+        if old is not None:
+            old.stop(seconds, curve=1 - falling)
+        return self.add(new)
+
+    def stop_all(self, fade: float = default_fade_seconds) -> None:
+        """
+        Stop every sound.
+
+        :param fade: The length of the fade out in seconds.
+        :type fade: float
+        """
+        with self.lock:
+            sounds = list(self.sounds)
+        for sound in sounds:
+            sound.stop(fade)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        """
+        Mix the next buffer of every active sound.
+
+        :param in_data: input data, unused
+        :type in_data: bytes
+        :param frame_count: number of frames
+        :type frame_count: int
+        :param time_info: time information
+        :type time_info: dict
+        :param status: stream status
+        :type status: int
+        :return: The mixed audio and the stream status.
+        :rtype: tuple
+        """
+        with self.lock:
+            sounds = list(self.sounds)
+        mix = zeros((frame_count, self.channels), dtype=float32)
+        finished = []
+        for sound in sounds:
+            if not sound.done():
+                block = sound.render(frame_count)
+                mix[:len(block)] += block
+            if sound.done():
+                finished.append(sound)
+        if finished:
+            with self.lock:
+                self.sounds = [sound for sound in self.sounds if sound not in finished]
+        return to_int16(mix).tobytes(), paContinue
+
+    def close(self) -> None:
+        """
+        Stop every sound and close the output device.
+        """
+        with self.lock:
+            sounds, self.sounds = self.sounds, []
+        for sound in sounds:
+            sound.finished.set()
+        if self.stream is not None:
+            try:
+                self.stream.stop_stream()
+                self.stream.close()
+            except Exception as e:
+                logger.error(f"Failed to stop the output mixer: {e}")
+            self.stream = None
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
+
+
+mixer = None
+mixer_lock = threading.Lock()
+
+
+def get_mixer() -> Mixer:
+    """
+    Get the output mixer for this process, opening the device the first time.
+
+    :return: The running mixer.
+    :rtype: Mixer
+    """
+    global mixer
+    with mixer_lock:
+        if mixer is None:
+            mixer = Mixer()
+            mixer.start()
+            atexit.register(close_mixer)
+        return mixer
+
+
+def close_mixer() -> None:
+    """
+    Close the output mixer for this process if it was opened.
+    """
+    global mixer
+    with mixer_lock:
+        if mixer is not None:
+            mixer.close()
+            mixer = None
+
+
+def benchmark(frames: int, trials: int = 40, seconds: float = 0.3) -> dict:
+    """
+    Measure the time from a stop event being set to the sound it stops going silent.
+
+    A mixer with no device is driven by a thread that asks for a buffer every frames / mixer_rate seconds, like
+    PortAudio would, while the event is set at a random moment. The buffer returned by a callback is assumed to
+    start playing one period later, so the measured time includes the buffer queued ahead but not the device's own
+    output latency, which is the same for every buffer size.
+
+    :param frames: The number of frames per callback.
+    :type frames: int
+    :param trials: The number of stops to measure.
+    :type trials: int
+    :param seconds: The longest wait before the event is set in each trial.
+    :type seconds: float
+    :return: The median, 95th percentile and worst latency in milliseconds.
+    :rtype: dict
+    """
+    period = frames / mixer_rate
+    tone = (sin(arange(mixer_rate) * 2 * pi * 440 / mixer_rate) * 16000).astype(int16)[:, newaxis]
+    tone = repeat(tone, mixer_channels, axis=1)
+    latencies = []
+    for _ in range(trials):
+        test_mixer = Mixer(frames=frames)
+        event = threading.Event()
+        sound = test_mixer.play(tone, loops=None).stop_on(event)
+        silent_at = []
+
+        def device():
+            start = time.perf_counter()
+            count = 0
+            while not silent_at:
+                count += 1
+                time.sleep(max(0.0, start + count * period - time.perf_counter()))
+                called = time.perf_counter()
+                output = frombuffer(test_mixer._callback(None, frames, None, 0)[0], dtype=int16)
+                if sound.done():
+                    audible = flatnonzero(output)
+                    last = audible[-1] + 1 if len(audible) else 0
+                    silent_at.append(called + period + last / mixer_channels / mixer_rate)
+
+        thread = threading.Thread(target=device)
+        thread.start()
+        time.sleep(random.uniform(0.05, seconds))
+        set_at = time.perf_counter()
+        event.set()
+        thread.join()
+        latencies.append((silent_at[0] - set_at) * 1000)
+    return {"median": float(median(latencies)),
+            "p95": float(percentile(latencies, 95)),
+            "max": float(max(latencies))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure skip to silence latency of the output mixer for several "
+                                                 "buffer sizes.")
+    parser.add_argument("--frames", help="Comma separated buffer sizes in frames", type=str,
+                        default=f"8196,2048,1024,{mixer_frames}")
+    parser.add_argument("--trials", help="Stops to measure per buffer size", type=int, default=40)
+    args = parser.parse_args()
+    print(f"{'frames':>7} | {'buffer':>7} | {'median':>7} | {'p95':>7} | {'max':>7}")
+    for size in (int(value) for value in args.frames.split(",")):
+        result = benchmark(size, args.trials)
+        print(f"{size:>7} | {size / mixer_rate * 1000:5.1f}ms | {result['median']:5.1f}ms | {result['p95']:5.1f}ms | "
+              f"{result['max']:5.1f}ms")
@@ -1,32 +1,146 @@
+import argparse
 import atexit
-import pyaudio
 import os
 import sys
 import time
 import threading
 import wave
-import struct
-from numpy import linspace, int16, sqrt, maximum, mean, square, frombuffer
+import queue
+from typing import Optional
+from ctypes import c_int, c_short, POINTER, byref
+from numpy import ndarray, int16, frombuffer, concatenate, zeros, ascontiguousarray
+from audio_mixer import get_mixer, close_mixer, to_mixer_samples, mixer_rate, mixer_channels
+from audio_dsp import Resampler
+from mic_service import subscribe, MicrophoneServiceError
 
 # Configure logging
 import logger_config
 logger = logger_config.get_logger()
 
-pa = pyaudio.PyAudio()
 audio_stream = None
+wake_fallback_logged = False
+
+# Configuration
+frame_queue_frames = 32  # Wake word frames, about a second, buffered between the capture thread and Porcupine
+frame_read_timeout = 2.0
+cue_folders = ["audio_files", "free_audio_files"]  # Decoded once by preload_cues
+cue_cache = {}
+cue_wait_margin = 1.0  # Seconds past a cue's length before a blocking playback stops waiting for the mixer
+
+
+class Cue:
+    """
+    A decoded sound, converted to the output mixer's format so it can be played and looped without touching the disk.
+
+    :param samples: int16 samples shaped (frames, channels) at the mixer rate.
+    :type samples: numpy.ndarray
+    """
+
+    def __init__(self, samples: ndarray) -> None:
+        """
+        Initialize the cue.
+
+        :param samples: int16 samples shaped (frames, channels) at the mixer rate.
+        :type samples: numpy.ndarray
+        """
+        self.samples = samples
+
+
+def resolve_path(file_path: str) -> str:
+    """
+    Resolve a bundled file path, which lives under the PyInstaller folder when frozen.
+
+    :param file_path: The path relative to the app.
+    :type file_path: str
+    :return: The path to open.
+    :rtype: str
+    """
+    if getattr(sys, 'frozen', False):
+        file_path = os.path.join(sys._MEIPASS, file_path)
+    return os.path.normpath(file_path)
+
+
+def is_bundled_cue(file_path: str) -> bool:
+    """
+    Check whether a file lives in one of the cue folders, as opposed to a one-off file like a spoken response.
+
+    :param file_path: The resolved path to the file.
+    :type file_path: str
+    :return: True if the file is a bundled cue worth caching.
+    :rtype: bool
+    """
+    folder = os.path.dirname(os.path.abspath(file_path))
+    return any(folder == os.path.abspath(resolve_path(cue_folder)) for cue_folder in cue_folders)
+
+
+def load_cue(file_path: str) -> Cue:
+    """
+    Decode a WAV file into memory.
+
+    :param file_path: The resolved path to the file.
+    :type file_path: str
+    :return: The decoded sound.
+    :rtype: Cue
+    """
+    with wave.open(file_path, 'rb') as wf:
+        if wf.getsampwidth() != 2:
+            raise wave.Error(f"only 16-bit audio is supported, {file_path} has {wf.getsampwidth() * 8}-bit samples")
+        samples = frombuffer(wf.readframes(wf.getnframes()), dtype=int16)
+        if wf.getnchannels() != mixer_channels:
+            logger.info(f"Mixing {file_path} from {wf.getnchannels()} to {mixer_channels} channels.")
+        return Cue(to_mixer_samples(samples, wf.getnchannels(), wf.getframerate()))
+
+
+def get_cue(file_path: str, cache: bool = True) -> Cue:
+    """
+    Get a decoded sound from the cache, decoding it from disk if it is not there yet.
+
+    :param file_path: The resolved path to the file.
+    :type file_path: str
+    :param cache: Whether to keep a newly decoded sound, False for one-off files like spoken responses.
+    :type cache: bool
+    :return: The decoded sound.
+    :rtype: Cue
+    """
+    cue = cue_cache.get(file_path)
+    if cue is None:
+        cue = load_cue(file_path)
+        if cache:
+            cue_cache[file_path] = cue
+    return cue
+
+
+def preload_cues() -> None:
+    """
+    Decode every bundled cue, paid and free variants alike, so playing one only costs handing it to the mixer.
+    """
+    start = time.time()
+    for folder in cue_folders:
+        folder = resolve_path(folder)
+        if not os.path.isdir(folder):
+            continue
+        for file in sorted(os.listdir(folder)):
+            if file.lower().endswith(".wav"):
+                try:
+                    get_cue(os.path.join(folder, file))
+                except (wave.Error, EOFError) as e:
+                    logger.error(f"Failed to decode cue {file}: {e}")
+    size = sum(cue.samples.nbytes for cue in cue_cache.values())
+    logger.info(f"Decoded {len(cue_cache)} cues ({size / 1e6:.1f} MB) in {time.time() - start:.2f}s.")
 
 
 def play_audio_file(file_path, blocking: bool = True, loops=1, delay: float = 0, destroy=False,
                     added_stop_event: threading.Event = None) -> threading.Event:
     """
-    Play an audio file using pyaudio.
+    Play an audio file through the output mixer.
 
     :param file_path: path to the audio file or list of paths to play in sequence
     :type file_path: str or list of str
     :param blocking: whether the audio playback should block the main thread (default: True)
     :type blocking: bool
-    :param loops: the number of times to loop the audio file (default: 1) or list of loop counts for each file
-    :type loops: int or list of int
+    :param loops: the number of times to loop the audio file (default: 1), None to loop until a stop event is set,
+        or list of loop counts for each file. Loops are played back to back from memory without a gap.
+    :type loops: int or list of int, optional
     :param delay: the delay in seconds before starting playback (default: 0)
     :type delay: float
     :param destroy: whether to destroy the file after playback (default: False) or list of destroy flags for each file
@@ -37,6 +151,9 @@ def play_audio_file(file_path, blocking: bool = True, loops=1, delay: float = 0,
     :rtype: threading.Event
     """
     stop_event = threading.Event()
+    endless = loops is None or (isinstance(loops, list) and None in loops)
+    if endless and blocking and added_stop_event is None:
+        raise ValueError("Looping until stopped needs non-blocking playback or an added stop event.")
 
     if blocking:
         time.sleep(delay)
@@ -52,14 +169,14 @@ def play_audio_file(file_path, blocking: bool = True, loops=1, delay: float = 0,
 def _play_audio_file_blocking(file_path: str, stop_event: threading.Event, loops: int, delay: float, destroy: bool,
                               added_stop_event: threading.Event):
     """
-    Play an audio file using pyaudio, blocking the calling thread until playback is complete or stopped.
+    Play an audio file through the output mixer, blocking the calling thread until playback is complete or stopped.
 
     :param file_path: path to the audio file
     :type file_path: str
     :param stop_event: an event to signal stopping the playback
     :type stop_event: threading.Event
-    :param loops: the number of times to loop the audio file
-    :type loops: int
+    :param loops: the number of times to loop the audio file, None to loop until a stop event is set
+    :type loops: int, optional
     :param delay: the delay in seconds before starting playback
     :type delay: float
     :param destroy: whether to destroy the file after playback
@@ -67,16 +184,7 @@ def _play_audio_file_blocking(file_path: str, stop_event: threading.Event, loops
     :param added_stop_event: an event to signal stopping the playback
     :type added_stop_event: threading.Event
     """
-    global pa
-    global audio_stream
-    stream = None
     if isinstance(file_path, list):
-        if getattr(sys, 'frozen', False):
-            files_updated = []
-            for file in file_path:
-                file = os.path.join(sys._MEIPASS, file)
-                files_updated.append(file)
-            file_path = files_updated
         if isinstance(loops, list) and isinstance(destroy, list):
             for i, file in enumerate(file_path):
                 _play_audio_file_blocking(file, stop_event, loops[i], delay, destroy[i], added_stop_event)
@@ -88,82 +196,137 @@ def _play_audio_file_blocking(file_path: str, stop_event: threading.Event, loops
                 _play_audio_file_blocking(file, stop_event, loops, delay, destroy, added_stop_event)
         return
     else:
-        if getattr(sys, 'frozen', False):
-            file_path = os.path.join(sys._MEIPASS, file_path)
-        chunk = 8196
-        if audio_stream is not None:
-            logger.warning("Audio stream already exists, closing it...")
-            stop_audio_stream()
+        file_path = resolve_path(file_path)
         added_stop = False
         if added_stop_event is not None:
             if added_stop_event.is_set():
                 added_stop = True
         if not stop_event.is_set() and not added_stop:
             time.sleep(delay)
-            for loop in range(loops):
-                with wave.open(file_path, 'rb') as wf:
-                    stream = pa.open(format=pa.get_format_from_width(wf.getsampwidth()),
-                                     channels=wf.getnchannels(),
-                                     rate=wf.getframerate(),
-                                     output=True,
-                                     frames_per_buffer=chunk)
-
-                    data = wf.readframes(chunk)
-                    while data:
-                        if added_stop_event is not None:
-                            if added_stop_event.is_set():
-                                added_stop = True
-                        if not stop_event.is_set() and not added_stop:
-                            stream.write(data)
-                            data = wf.readframes(chunk)
-                        else:
-                            data = fade_out(data, 400)  # Adjust fade_duration for a very short fade-out
-                            stream.write(data)
-                            break
-        if stream is not None:
-            try:
-                stream.stop_stream()
-            finally:
-                stream.close()
+            cue = get_cue(file_path, cache=not destroy and is_bundled_cue(file_path))
+            # The mixer checks the stop events on every buffer, so a stop is heard within about 20 ms
+            sound = get_mixer().play(cue.samples, loops=loops).stop_on(stop_event, added_stop_event)
+            # Never wait on the mixer for much longer than the cue lasts, an endless loop is checked once per lap
+            timeout = len(cue.samples) / mixer_rate * (loops or 1) + cue_wait_margin
+            while not sound.wait(timeout):
+                if loops is not None or stop_event.is_set() or (added_stop_event is not None and
+                                                                added_stop_event.is_set()):
+                    logger.warning(f"Playback of {file_path} did not finish within {timeout:.1f}s, stopping it.")
+                    sound.stop(0)
+                    break
         if destroy:
             os.remove(file_path)
 
 
-def fade_out(data: bytes, fade_duration: int, rms_threshold: int = 1000) -> bytes:
+class FrameReader:
     """
-    Fade out the audio data.
+    Reads fixed length frames from the shared microphone on its own thread into a bounded queue.
+
+    The wake word loop takes frames from the queue, so a slow inference call never stalls capture. If the loop falls
+    more than the queue behind, the oldest frames are dropped and counted in dropped rather than lost silently.
 
-    :param data: the audio data to fade out
-    :type data: bytes
-    :param fade_duration: the duration of the fade in samples
-    :type fade_duration: int
-    :param rms_threshold: the threshold for determining if audio is present
-    :type rms_threshold: int
-    :return: the audio data with a fade-out applied
-    :rtype: bytes
+    :param rate: The sample rate the frames should have.
+    :type rate: int
+    :param length: The number of samples per frame.
+    :type length: int
+    :param max_frames: The number of frames the queue holds.
+    :type max_frames: int
     """
 
-    def rms(aud_data):
-        return sqrt(maximum(mean(square(aud_data)), 0))
+    def __init__(self, rate: int, length: int, max_frames: int = frame_queue_frames) -> None:
+        """
+        Subscribe to the shared microphone and start the capture thread.
+
+        :param rate: The sample rate the frames should have.
+        :type rate: int
+        :param length: The number of samples per frame.
+        :type length: int
+        :param max_frames: The number of frames the queue holds.
+        :type max_frames: int
+        """
+        self.length = length
+        self.frames = queue.Queue(maxsize=max_frames)
+        self.dropped = 0
+        self.subscriber = subscribe()
+        self.position = self.subscriber.position
+        self.resampler = None
+        if self.subscriber.sample_rate != rate:
+            self.resampler = Resampler(self.subscriber.sample_rate, rate)
+        self.running = True
+        self.thread = threading.Thread(target=self._capture)
+        self.thread.daemon = True
+        self.thread.start()
 
-    num_samples = len(data) // 2  # Divide by 2 for 16-bit audio samples
-    fade_samples = min(num_samples, fade_duration)
-    audio_data = frombuffer(data, dtype=int16).copy()  # Create a writeable copy of the array
+    def _capture(self) -> None:
+        """
+        Capture loop that cuts the shared microphone into frames and queues them with their end position.
+        """
+        pending = zeros(0, dtype=int16)
+        while self.running:
+            try:
+                if self.resampler is None:
+                    frame = self.subscriber.read(self.length)
+                    end = self.subscriber.position
+                else:
+                    input_length = self.resampler.down * self.length // self.resampler.up
+                    while len(pending) < self.length:
+                        pending = concatenate((pending, self.resampler.process(self.subscriber.read(input_length))))
+                    frame, pending = pending[:self.length], pending[self.length:]
+                    end = self.subscriber.position - len(pending) * self.resampler.down // self.resampler.up
+            except MicrophoneServiceError as e:
+                if self.running:
+                    logger.error(f"Error while reading from the audio stream: {e}")
+                    time.sleep(0.1)
+                continue
+            except Exception as e:
+                if self.running:
+                    logger.error(f"Audio stream capture stopped: {e}")
+                return
+
+            if self.frames.full():
+                try:
+                    self.frames.get_nowait()
+                    self.dropped += 1
+                    if self.dropped == 1 or self.dropped % 100 == 0:
+                        logger.warning(f"Wake word detection is falling behind, {self.dropped} frames dropped.")
+                except queue.Empty:
+                    pass
+            self.frames.put((frame, end))
+
+    def read(self, timeout: float = frame_read_timeout) -> Optional[ndarray]:
+        """
+        Take the next frame.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        :return: The int16 frame, or None if no audio arrived in time.
+        :rtype: numpy.ndarray, optional
+        """
+        try:
+            frame, self.position = self.frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return frame
 
-    start_fade = 0
-    for i in range(0, num_samples - fade_samples, fade_samples):
-        if rms(audio_data[i:i + fade_samples]) < rms_threshold:
-            start_fade = i
-            break
+    def close(self) -> int:
+        """
+        Stop capturing and detach from the shared microphone.
 
-    fade = linspace(1, 0, num_samples - start_fade).astype(int16)  # Convert fade array to int16
-    audio_data[start_fade:] *= fade
-    return audio_data.tobytes()
+        :return: The shared microphone position right after the last frame taken.
+        :rtype: int
+        """
+        self.running = False
+        self.thread.join(frame_read_timeout + 1)
+        self.subscriber.close()
+        return self.position
 
 
 def start_audio_stream(rate: int, length: int) -> None:
     """
-    Start the audio stream.
+    Start the audio stream by subscribing to the shared microphone at its live edge.
+
+    Frames are captured on their own thread. If the shared microphone runs at a different rate than requested every
+    frame is resampled before it is returned by get_next_audio_frame.
 
     :param rate: the sampling rate of the audio stream
     :type rate: int
@@ -171,51 +334,136 @@ def start_audio_stream(rate: int, length: int) -> None:
     :type length: int
     """
     global audio_stream
-    audio_stream = pa.open(rate=rate, channels=1, format=pyaudio.paInt16, input=True,
-                           frames_per_buffer=length, input_device_index=None)
+    stop_audio_stream()
+    audio_stream = FrameReader(rate, length)
 
 
-def stop_audio_stream() -> None:
+def stop_audio_stream() -> Optional[int]:
     """
     Stop the audio stream.
+
+    :return: The shared microphone position right after the last frame returned, so a listener can carry on from
+        exactly there, or None if there was no stream.
+    :rtype: int, optional
     """
     global audio_stream
+    position = None
     if audio_stream is not None:
         try:
-            audio_stream.stop_stream()
-            audio_stream.close()
+            position = audio_stream.close()
         except Exception as e:
             logger.error(f"Failed to stop the audio stream: {e}")
         finally:
             audio_stream = None
+    return position
 
 
-def get_next_audio_frame(handle):
+def get_next_audio_frame(handle) -> Optional[ndarray]:
     """
     Read the next frame from the audio stream.
 
     :param handle: The Porcupine handle
-    :return: tuple, the unpacked PCM data
+    :return: The int16 frame, which process_wake_frame can pass to Porcupine without copying, or None
+    :rtype: numpy.ndarray, optional
     """
-    global audio_stream
-    try:
-        pcm = audio_stream.read(handle.frame_length, exception_on_overflow=False)
-    except pyaudio.PyAudioError as e:
-        logger.error(f"Input overflow error while reading from the audio stream: {e}")
+    if audio_stream is None:
+        return None
+    return audio_stream.read()
+
+
+def native_process_function(handle):
+    """
+    Find Porcupine's native process function on a handle, logging once if it is not there.
+
+    :param handle: The Porcupine handle
+    :return: The ctypes function, or None if this version of pvporcupine does not expose it.
+    """
+    global wake_fallback_logged
+    process_func = getattr(handle, "_process_func", None)
+    if process_func is None or getattr(handle, "_handle", None) is None:
+        if not wake_fallback_logged:
+            logger.warning("Porcupine's native process function was not found, wake word frames are converted to "
+                           "a list for handle.process() instead.")
+            wake_fallback_logged = True
         return None
+    return process_func
+
+
+def process_wake_frame(handle, frame: ndarray) -> int:
+    """
+    Run Porcupine on a frame by handing it a pointer to the numpy buffer.
 
-    pcm = struct.unpack_from("h" * handle.frame_length, pcm)
-    return pcm
+    Porcupine's own process() builds a ctypes array from one Python int per sample, on every frame, for as long as
+    the assistant is in standby. The native function is called directly when the handle exposes it, and process()
+    is used otherwise or to raise Porcupine's own exception if the call fails.
+
+    :param handle: The Porcupine handle
+    :param frame: int16 samples, handle.frame_length of them.
+    :type frame: numpy.ndarray
+    :return: The index of the detected keyword, or -1.
+    :rtype: int
+    """
+    process_func = native_process_function(handle)
+    if process_func is None or len(frame) != handle.frame_length:
+        # A list of Python ints converts far faster than iterating over numpy scalars
+        return handle.process(frame.tolist())
+    frame = ascontiguousarray(frame, dtype=int16)
+    result = c_int()
+    status = process_func(handle._handle, frame.ctypes.data_as(POINTER(c_short)), byref(result))
+    if status is not handle.PicovoiceStatuses.SUCCESS:
+        return handle.process(frame.tolist())
+    return result.value
+
+
+def benchmark_wake_frames(handle, frames: int = 2000) -> dict:
+    """
+    Time process_wake_frame against handle.process() on the unpacked tuple the wake word loop used to pass.
+
+    :param handle: The Porcupine handle
+    :param frames: The number of silent frames to process with each.
+    :type frames: int
+    :return: Microseconds per frame for both, and whether the native fast path was used.
+    :rtype: dict
+    """
+    frame = zeros(handle.frame_length, dtype=int16)
+    start = time.perf_counter()
+    for _ in range(frames):
+        handle.process(tuple(frame.tolist()))
+    tuple_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(frames):
+        process_wake_frame(handle, frame)
+    frame_seconds = time.perf_counter() - start
+    return {"fast_path": native_process_function(handle) is not None,
+            "tuple": tuple_seconds / frames * 1e6,
+            "process_wake_frame": frame_seconds / frames * 1e6}
 
 
 def shutdown_audio() -> None:
     """
-    Shutdown the audio stream and terminate the pyaudio instance.
+    Shutdown the audio stream and the output mixer.
     """
     global audio_stream
-    global pa
     stop_audio_stream()
-    pa.terminate()
+    close_mixer()
 
 
 atexit.register(shutdown_audio)
+
+
+if __name__ == "__main__":
+    import pvporcupine
+    from connections import get_pico_key, get_pico_wake_path
+
+    parser = argparse.ArgumentParser(description="Compare the cost of handing wake word frames to Porcupine.")
+    parser.add_argument("--frames", help="Frames to process with each method", type=int, default=2000)
+    args = parser.parse_args()
+    porcupine = pvporcupine.create(access_key=get_pico_key(), keywords=['Jarvis'],
+                                   keyword_paths=[get_pico_wake_path()])
+    try:
+        result = benchmark_wake_frames(porcupine, args.frames)
+    finally:
+        porcupine.delete()
+    print(f"native fast path used: {result['fast_path']}")
+    print(f"handle.process(tuple): {result['tuple']:.1f}us per frame")
+    print(f"process_wake_frame:    {result['process_wake_frame']:.1f}us per frame")
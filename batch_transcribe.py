@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from numpy import zeros, float32
+
+from stt_backends import backends, create_backend
+from stt_benchmark import load_clip
+
+# Parse input arguments
+parser = argparse.ArgumentParser(
+    description="Transcribe every WAV and FLAC file in a folder across a pool of processes, each keeping one warm "
+                "model, and write the transcripts and timings as JSON lines. Use it to re-transcribe archived "
+                "queries after a model change or to measure the throughput of the speech to text stage.")
+parser.add_argument(
+    "folder",
+    help="The folder of clips, searched recursively",
+    type=str
+)
+parser.add_argument(
+    "--output",
+    help="The JSONL file to write, defaults to transcripts.jsonl inside the folder",
+    type=str,
+    default=None
+)
+parser.add_argument(
+    "--backend",
+    help="The speech to text backend, one of " + ", ".join(backends),
+    type=str,
+    default="whisper"
+)
+parser.add_argument(
+    "--model",
+    help="The model every worker should load",
+    type=str,
+    default="base.en"
+)
+parser.add_argument(
+    "--workers",
+    help="The number of worker processes",
+    type=int,
+    default=max(1, (os.cpu_count() or 2) // 2)
+)
+parser.add_argument(
+    "--threads",
+    help="The number of torch threads per worker, 0 leaves the torch default",
+    type=int,
+    default=2
+)
+
+# The model loaded by this worker process, set once by init_worker
+worker_backend = None
+
+
+def init_worker(backend_name: str, model_name: str, threads: int) -> None:
+    """
+    Load and warm the model once when a worker process starts.
+
+    :param backend_name: The name of the speech to text backend.
+    :type backend_name: str
+    :param model_name: The name of the model to load.
+    :type model_name: str
+    :param threads: The number of torch threads to use, 0 to leave the default.
+    :type threads: int
+    """
+    global worker_backend
+    if threads:
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+    worker_backend = create_backend(backend_name, model_name)
+    worker_backend.load()
+    worker_backend.transcribe(zeros(16000, dtype=float32))
+
+
+def transcribe_file(path: str) -> dict:
+    """
+    Transcribe one file with this worker's model.
+
+    :param path: The path to the clip.
+    :type path: str
+    :return: The file, its transcript and how long it took.
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    audio = load_clip(path)
+    loaded = time.perf_counter()
+    text = worker_backend.transcribe(audio)
+    finished = time.perf_counter()
+    return {"file": path,
+            "text": text.strip(),
+            "audio_seconds": round(len(audio) / 16000, 3),
+            "load_seconds": round(loaded - start, 3),
+            "decode_seconds": round(finished - loaded, 3),
+            "worker": os.getpid()}
+
+
+def find_clips(folder: str) -> list:
+    """
+    Find every WAV and FLAC file below a folder.
+
+    :param folder: The folder to search.
+    :type folder: str
+    :return: The sorted paths.
+    :rtype: list
+    """
+    clips = []
+    for root, _, files in os.walk(folder):
+        for file in files:
+            if os.path.splitext(file)[1].lower() in (".wav", ".flac"):
+                clips.append(os.path.join(root, file))
+    return sorted(clips)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    clips = find_clips(args.folder)
+    output_path = args.output or os.path.join(args.folder, "transcripts.jsonl")
+    print(f"Transcribing {len(clips)} clips with {args.workers} workers of {args.backend} '{args.model}'...")
+
+    start = time.perf_counter()
+    audio_seconds = 0.0
+    decode_seconds = 0.0
+    failures = 0
+    with open(output_path, "w") as output, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                initargs=(args.backend, args.model, args.threads)) as pool:
+        futures = {pool.submit(transcribe_file, clip): clip for clip in clips}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                result = {"file": futures[future], "error": str(e)}
+            else:
+                audio_seconds += result["audio_seconds"]
+                decode_seconds += result["decode_seconds"]
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    wall_seconds = time.perf_counter() - start
+
+    print(f"Wrote {output_path}")
+    print(f"{audio_seconds:.1f}s of audio in {wall_seconds:.1f}s wall time, {failures} failed")
+    if wall_seconds:
+        print(f"Throughput {audio_seconds / wall_seconds:.1f}x real time, "
+              f"per worker real time factor {decode_seconds / audio_seconds if audio_seconds else 0.0:.3f}")
@@ -0,0 +1,190 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from numpy import float32
+from soundfile import read
+
+import audio_listener
+from audio_capture import CaptureBuffer
+from audio_dsp import Resampler
+from audio_listener import save_wav
+from endpointing import AdaptiveEndpointer
+from mic_service import subscribe
+from speech_model import manager
+from streaming_transcription import find_quiet_cut, prompt_characters
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+# Configuration
+sample_rate = 16000
+segment_seconds = 30.0  # Audio held in memory before it is spilled to disk and queued for transcription
+max_dictation_seconds = 30 * 60
+dictation_settings = {"silence_seconds": 4.0,  # Pauses to think are normal while dictating
+                      "short_silence_seconds": 4.0,
+                      "sentence_complete_silence_seconds": 4.0,
+                      "no_speech_seconds": 10.0}
+
+
+class DictationSession:
+    """
+    Records long dictation with bounded memory, transcribing it progressively.
+
+    Audio is collected into a segment of about segment_seconds, which is cut at a quiet point, written to a WAV file
+    in a temporary folder and queued. A worker thread transcribes the queued files in order, passing the end of the
+    transcript so far as context, and deletes each file once it is done. Only one segment is ever held in memory and
+    at stop time only the last segment is left to decode.
+
+    :param folder: The folder to spill segments to, a new temporary folder if not given.
+    :type folder: str, optional
+    """
+
+    def __init__(self, folder: Optional[str] = None) -> None:
+        """
+        Initialize the session and start its worker thread.
+
+        :param folder: The folder to spill segments to, a new temporary folder if not given.
+        :type folder: str, optional
+        """
+        self.own_folder = folder is None
+        self.folder = folder or tempfile.mkdtemp(prefix="jarvis_dictation_")
+        self.segment = CaptureBuffer(sample_rate, seconds=segment_seconds + 1, sample_type=float32)
+        self.segment_samples = int(segment_seconds * sample_rate)
+        self.segments = queue.Queue()
+        self.segment_count = 0
+        self.texts = []
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self._transcribe_segments)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self, audio) -> None:
+        """
+        Add newly captured audio, spilling a segment to disk once it is full.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        """
+        self.segment.append(audio)
+        if self.segment.length >= self.segment_samples:
+            recorded = self.segment.view()
+            cut = find_quiet_cut(recorded)
+            remainder = recorded[cut:].copy()
+            self._spill(recorded[:cut])
+            self.segment.clear()
+            self.segment.append(remainder)
+
+    def finish(self, timeout: Optional[float] = None) -> str:
+        """
+        Spill the last segment, wait for every segment to be transcribed and clean up.
+
+        :param timeout: The maximum number of seconds to wait for the transcript.
+        :type timeout: float, optional
+        :return: The full transcript.
+        :rtype: str
+        """
+        start = time.time()
+        if self.segment.length:
+            self._spill(self.segment.view())
+            self.segment.clear()
+        self.segments.put(None)
+        self.thread.join(timeout)
+        if self.own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+        if self.error is not None:
+            raise self.error
+        logger.info(f"Dictation of {self.segment_count} segments ready {time.time() - start:.2f}s after it stopped.")
+        return " ".join(self.texts).strip()
+
+    def abort(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop without transcribing what is left, deleting every spilled segment.
+
+        :param timeout: The maximum number of seconds to wait for the worker to stop.
+        :type timeout: float, optional
+        """
+        self.aborted = True
+        self.segment.clear()
+        self.segments.put(None)
+        self.thread.join(timeout)
+        if self.own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _spill(self, audio) -> None:
+        """
+        Write a segment to disk and queue it for transcription.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        """
+        path = os.path.join(self.folder, f"segment_{self.segment_count:04d}.wav")
+        save_wav(audio, path, sample_rate)
+        self.segment_count += 1
+        self.segments.put(path)
+
+    def _transcribe_segments(self) -> None:
+        """
+        Worker loop that transcribes spilled segments in order.
+        """
+        while True:
+            path = self.segments.get()
+            if path is None:
+                return
+            try:
+                if self.error is None and not self.aborted:
+                    audio, _ = read(path, dtype="float32")
+                    prompt = " ".join(self.texts)[-prompt_characters:] or None
+                    with manager.use() as model:
+                        self.texts.append(model.transcribe(audio, prompt=prompt).strip())
+            except Exception as e:
+                logger.error(f"Dictation transcription failed: {e}")
+                self.error = e
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def dictate(stop_event: Optional[threading.Event] = None, max_seconds: float = max_dictation_seconds) -> str:
+    """
+    Record dictation until the user pauses for a while, the stop event is set or max_seconds is reached.
+
+    :param stop_event: An event that ends the dictation when set.
+    :type stop_event: threading.Event, optional
+    :param max_seconds: The longest dictation to record.
+    :type max_seconds: float
+    :return: The transcript of the dictation.
+    :rtype: str
+    """
+    stream = subscribe()
+    settings = dict(dictation_settings, max_seconds=max_seconds)
+    endpointer = AdaptiveEndpointer(stream.sample_rate, settings)
+    resampler = Resampler(stream.sample_rate, sample_rate)
+    session = DictationSession()
+
+    logger.info("Taking dictation...")
+    recorded = False
+    try:
+        while stop_event is None or not stop_event.is_set():
+            samples = stream.read(2048)
+            session.feed(resampler.process(samples))
+            if endpointer.process(samples, audio_listener.current_energy_threshold):
+                break
+        recorded = True
+    finally:
+        stream.close()
+        if not recorded:
+            session.abort()
+    logger.info(f"Finished taking dictation after {endpointer.elapsed:.1f}s.")
+    return session.finish()
+
+
+if __name__ == "__main__":
+    audio_listener.prep_mic()
+    print(dictate())
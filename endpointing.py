@@ -0,0 +1,410 @@
+import argparse
+import os
+from typing import Optional
+
+from numpy import ndarray, float32, square, abs as np_abs, exp, log2, percentile, median
+from numpy.fft import rfft, rfftfreq
+
+from audio_capture import RollingEnergy, chunk_volume
+
+# Configuration
+adaptive_settings = {"silence_seconds": 0.8,  # Trailing silence needed after a normal utterance
+                     "short_utterance_seconds": 1.0,  # Utterances shorter than this get the longer silence below
+                     "short_silence_seconds": 1.5,
+                     "sentence_complete_silence_seconds": 0.5,  # Used when the transcript so far ends a sentence
+                     "use_transcript_hint": False,
+                     "min_speech_seconds": 0.2,  # Speech needed before an endpoint is possible at all
+                     "no_speech_seconds": 5.0,  # Give up if nothing is said for this long
+                     "max_seconds": None,
+                     "speech_on": 0.6,  # Smoothed speech probability needed to enter the speaking state
+                     "speech_off": 0.4,  # Smoothed speech probability needed to leave the speaking state
+                     "smoothing": 0.5,
+                     "energy_weight": 2.0,
+                     "spectral_weight": 4.0,
+                     "band_ratio_center": 0.5,
+                     "speech_band": (300, 3400)}
+fixed_settings = {"min_seconds": 3.0,
+                  "silence_seconds": 2.5,
+                  "window_size": 10}
+
+
+class Endpointer:
+    """
+    Decides when the user has finished speaking.
+
+    Subclasses are fed every captured chunk through process() and return True once recording should stop.
+
+    :param sample_rate: The sample rate of the audio that will be processed.
+    :type sample_rate: int
+    """
+
+    def __init__(self, sample_rate: int) -> None:
+        """
+        Initialize the endpointer.
+
+        :param sample_rate: The sample rate of the audio that will be processed.
+        :type sample_rate: int
+        """
+        self.sample_rate = sample_rate
+        self.elapsed = 0.0
+        self.transcript = ""
+        self.speech_start = None
+        self.speech_end = None
+
+    def reset(self) -> None:
+        """
+        Forget everything seen so far so the endpointer can be reused.
+        """
+        self.elapsed = 0.0
+        self.transcript = ""
+        self.speech_start = None
+        self.speech_end = None
+
+    def mark_speech(self, is_speech: bool, seconds: float) -> None:
+        """
+        Record whether the chunk that was just processed held speech, to find where speech starts and ends.
+
+        Must be called after elapsed has been advanced past the chunk.
+
+        :param is_speech: True if the chunk held speech.
+        :type is_speech: bool
+        :param seconds: The duration of the chunk.
+        :type seconds: float
+        """
+        if is_speech:
+            if self.speech_start is None:
+                self.speech_start = self.elapsed - seconds
+            self.speech_end = self.elapsed
+
+    def speech_bounds(self, sample_rate: int, guard: float = 0.0) -> Optional[tuple]:
+        """
+        Get the part of the recording that holds speech, widened by a guard margin on both sides.
+
+        :param sample_rate: The sample rate of the recording to index.
+        :type sample_rate: int
+        :param guard: Seconds of audio to keep before the first and after the last speech chunk.
+        :type guard: float
+        :return: The start and end sample indices, or None if no speech was seen.
+        :rtype: tuple, optional
+        """
+        if self.speech_start is None:
+            return None
+        start = max(0, int((self.speech_start - guard) * sample_rate))
+        end = int(min(self.speech_end + guard, self.elapsed) * sample_rate)
+        return start, end
+
+    def update_transcript(self, text: str) -> None:
+        """
+        Give the endpointer the partial transcript of what has been said so far.
+
+        :param text: The partial transcript.
+        :type text: str
+        """
+        self.transcript = text
+
+    def process(self, samples: ndarray, threshold: float) -> bool:
+        """
+        Process a chunk of audio.
+
+        :param samples: int16 samples.
+        :type samples: numpy.ndarray
+        :param threshold: The current ambient energy threshold.
+        :type threshold: float
+        :return: True if recording should stop after this chunk.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+
+class FixedEndpointer(Endpointer):
+    """
+    The original rule: wait at least min_seconds, then stop after silence_seconds below the energy threshold.
+
+    :param sample_rate: The sample rate of the audio that will be processed.
+    :type sample_rate: int
+    """
+
+    def __init__(self, sample_rate: int) -> None:
+        """
+        Initialize the endpointer.
+
+        :param sample_rate: The sample rate of the audio that will be processed.
+        :type sample_rate: int
+        """
+        super().__init__(sample_rate)
+        self.volume_window = RollingEnergy(fixed_settings["window_size"])
+        self.silence_duration = 0.0
+
+    def reset(self) -> None:
+        """
+        Forget everything seen so far so the endpointer can be reused.
+        """
+        super().reset()
+        self.volume_window = RollingEnergy(fixed_settings["window_size"])
+        self.silence_duration = 0.0
+
+    def process(self, samples: ndarray, threshold: float) -> bool:
+        """
+        Process a chunk of audio.
+
+        :param samples: int16 samples.
+        :type samples: numpy.ndarray
+        :param threshold: The current ambient energy threshold.
+        :type threshold: float
+        :return: True if recording should stop after this chunk.
+        :rtype: bool
+        """
+        seconds = len(samples) / self.sample_rate
+        self.elapsed += seconds
+        volume = chunk_volume(samples)
+        self.mark_speech(volume >= threshold, seconds)
+        avg_volume = self.volume_window.add(volume)
+        if avg_volume < threshold and self.elapsed > fixed_settings["min_seconds"]:
+            self.silence_duration += seconds
+        else:
+            self.silence_duration = 0.0
+        return self.silence_duration > fixed_settings["silence_seconds"]
+
+
+class AdaptiveEndpointer(Endpointer):
+    """
+    Stops as soon as the user has clearly finished.
+
+    Each chunk gets a speech probability from its level above the ambient threshold and the share of its spectrum in
+    the speech band. The smoothed probability moves between a speaking and a silent state with hysteresis, and the
+    trailing silence needed to stop depends on how long the user spoke and, optionally, on whether the partial
+    transcript ends a sentence.
+
+    :param sample_rate: The sample rate of the audio that will be processed.
+    :type sample_rate: int
+    :param settings: Overrides for adaptive_settings.
+    :type settings: dict, optional
+    """
+
+    def __init__(self, sample_rate: int, settings: Optional[dict] = None) -> None:
+        """
+        Initialize the endpointer.
+
+        :param sample_rate: The sample rate of the audio that will be processed.
+        :type sample_rate: int
+        :param settings: Overrides for adaptive_settings.
+        :type settings: dict, optional
+        """
+        super().__init__(sample_rate)
+        self.settings = dict(adaptive_settings)
+        if settings:
+            self.settings.update(settings)
+        self.band_masks = {}
+        self.probability = 0.0
+        self.speaking = False
+        self.speech_duration = 0.0
+        self.silence_duration = 0.0
+
+    def reset(self) -> None:
+        """
+        Forget everything seen so far so the endpointer can be reused.
+        """
+        super().reset()
+        self.probability = 0.0
+        self.speaking = False
+        self.speech_duration = 0.0
+        self.silence_duration = 0.0
+
+    def speech_band_ratio(self, samples: ndarray) -> float:
+        """
+        Get the share of a chunk's energy that falls in the speech band.
+
+        :param samples: int16 samples.
+        :type samples: numpy.ndarray
+        :return: A ratio between 0 and 1.
+        :rtype: float
+        """
+        length = len(samples)
+        if length not in self.band_masks:
+            low, high = self.settings["speech_band"]
+            frequencies = rfftfreq(length, 1 / self.sample_rate)
+            self.band_masks[length] = (frequencies >= low) & (frequencies <= high)
+        spectrum = square(np_abs(rfft(samples.astype(float32))))
+        total = spectrum.sum()
+        if total <= 0:
+            return 0.0
+        return float(spectrum[self.band_masks[length]].sum() / total)
+
+    def speech_probability(self, samples: ndarray, threshold: float) -> float:
+        """
+        Estimate how likely a chunk is to contain speech.
+
+        :param samples: int16 samples.
+        :type samples: numpy.ndarray
+        :param threshold: The current ambient energy threshold.
+        :type threshold: float
+        :return: A probability between 0 and 1.
+        :rtype: float
+        """
+        snr = float(log2(max(chunk_volume(samples), 1.0) / max(threshold, 1.0)))
+        spectral = self.speech_band_ratio(samples) - self.settings["band_ratio_center"]
+        score = self.settings["energy_weight"] * snr + self.settings["spectral_weight"] * spectral
+        return float(1 / (1 + exp(-score)))
+
+    def required_silence(self) -> float:
+        """
+        Get the trailing silence needed to stop given what has been heard so far.
+
+        :return: The required silence in seconds.
+        :rtype: float
+        """
+        if self.settings["use_transcript_hint"] and self.transcript.rstrip().endswith((".", "?", "!")):
+            return self.settings["sentence_complete_silence_seconds"]
+        if self.speech_duration < self.settings["short_utterance_seconds"]:
+            return self.settings["short_silence_seconds"]
+        return self.settings["silence_seconds"]
+
+    def process(self, samples: ndarray, threshold: float) -> bool:
+        """
+        Process a chunk of audio.
+
+        :param samples: int16 samples.
+        :type samples: numpy.ndarray
+        :param threshold: The current ambient energy threshold.
+        :type threshold: float
+        :return: True if recording should stop after this chunk.
+        :rtype: bool
+        """
+        seconds = len(samples) / self.sample_rate
+        self.elapsed += seconds
+        smoothing = self.settings["smoothing"]
+        probability = self.speech_probability(samples, threshold)
+        self.mark_speech(probability > self.settings["speech_on"], seconds)
+        self.probability = smoothing * self.probability + (1 - smoothing) * probability
+
+        if self.speaking and self.probability < self.settings["speech_off"]:
+            self.speaking = False
+        elif not self.speaking and self.probability > self.settings["speech_on"]:
+            self.speaking = True
+
+        if self.speaking:
+            self.speech_duration += seconds
+            self.silence_duration = 0.0
+        else:
+            self.silence_duration += seconds
+
+        max_seconds = self.settings["max_seconds"]
+        if max_seconds is not None and self.elapsed >= max_seconds:
+            return True
+        if self.speech_duration < self.settings["min_speech_seconds"]:
+            return self.elapsed >= self.settings["no_speech_seconds"]
+        return not self.speaking and self.silence_duration >= self.required_silence()
+
+
+endpointers = {"fixed": FixedEndpointer, "adaptive": AdaptiveEndpointer}
+
+
+def make_endpointer(name: str, sample_rate: int) -> Endpointer:
+    """
+    Create an endpointer by name.
+
+    :param name: The name of the endpointer, one of the keys of endpointers.
+    :type name: str
+    :param sample_rate: The sample rate of the audio that will be processed.
+    :type sample_rate: int
+    :return: The new endpointer.
+    :rtype: Endpointer
+    """
+    if name not in endpointers:
+        raise ValueError(f"Unknown endpointer '{name}', expected one of {list(endpointers)}.")
+    return endpointers[name](sample_rate)
+
+
+def reference_speech_end(samples: ndarray, sample_rate: int, threshold: float, chunk: int) -> float:
+    """
+    Find where speech really ends in a clip, used as the ground truth for benchmarking.
+
+    :param samples: int16 samples of the whole clip.
+    :type samples: numpy.ndarray
+    :param sample_rate: The sample rate of the clip.
+    :type sample_rate: int
+    :param threshold: The ambient energy threshold.
+    :type threshold: float
+    :param chunk: The chunk size to measure the level over.
+    :type chunk: int
+    :return: The end of the last chunk above the threshold in seconds.
+    :rtype: float
+    """
+    end = 0
+    for i in range(0, len(samples), chunk):
+        if chunk_volume(samples[i:i + chunk]) > threshold:
+            end = min(i + chunk, len(samples))
+    return end / sample_rate
+
+
+def benchmark(folder: str, chunk: int = 2048, ratio: float = 1.5) -> dict:
+    """
+    Run every endpointer over a folder of recorded clips and report endpoint latency and cut-off rate.
+
+    Each clip should contain one query followed by a few seconds of silence. The ambient threshold is taken from the
+    quietest tenth of each clip, and the reference end of speech is the last chunk clearly above it, unless a
+    sidecar <clip>.end file gives it in seconds.
+
+    :param folder: The folder of WAV or FLAC clips.
+    :type folder: str
+    :param chunk: The chunk size to feed the endpointers.
+    :type chunk: int
+    :param ratio: How far above the quietest tenth the ambient threshold sits.
+    :type ratio: float
+    :return: Results per endpointer name.
+    :rtype: dict
+    """
+    from soundfile import read
+
+    clips = sorted(f for f in os.listdir(folder) if f.lower().endswith((".wav", ".flac")))
+    results = {name: {"latencies": [], "cut_offs": 0, "missed": 0} for name in endpointers}
+    for clip in clips:
+        path = os.path.join(folder, clip)
+        samples, sample_rate = read(path, dtype="int16")
+        if samples.ndim > 1:
+            samples = samples[:, 0]
+        levels = [chunk_volume(samples[i:i + chunk]) for i in range(0, len(samples), chunk)]
+        threshold = float(percentile(levels, 10)) * ratio + 1
+        end_path = os.path.splitext(path)[0] + ".end"
+        if os.path.exists(end_path):
+            with open(end_path, "r") as file:
+                speech_end = float(file.read().strip())
+        else:
+            speech_end = reference_speech_end(samples, sample_rate, threshold * 2, chunk)
+        for name in endpointers:
+            endpointer = make_endpointer(name, sample_rate)
+            stopped = None
+            for i in range(0, len(samples), chunk):
+                if endpointer.process(samples[i:i + chunk], threshold):
+                    stopped = min(i + chunk, len(samples)) / sample_rate
+                    break
+            if stopped is None:
+                results[name]["missed"] += 1
+            elif stopped < speech_end:
+                results[name]["cut_offs"] += 1
+            else:
+                results[name]["latencies"].append(stopped - speech_end)
+
+    for name, result in results.items():
+        latencies = result["latencies"]
+        result["clips"] = len(clips)
+        result["cut_off_rate"] = result["cut_offs"] / len(clips) if clips else 0.0
+        result["median_latency"] = float(median(latencies)) if latencies else None
+        result["p90_latency"] = float(percentile(latencies, 90)) if latencies else None
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the endpointers over a folder of recorded queries.")
+    parser.add_argument("folder", help="Folder of WAV or FLAC clips, each one query followed by silence")
+    parser.add_argument("--chunk", type=int, default=2048, help="Samples per chunk fed to the endpointers")
+    args = parser.parse_args()
+
+    for endpointer_name, endpointer_result in benchmark(args.folder, chunk=args.chunk).items():
+        median_latency = endpointer_result["median_latency"]
+        p90_latency = endpointer_result["p90_latency"]
+        print(f"{endpointer_name:>10} | clips {endpointer_result['clips']} "
+              f"| cut-off rate {endpointer_result['cut_off_rate']:.1%} "
+              f"| missed {endpointer_result['missed']} "
+              f"| median latency {'-' if median_latency is None else f'{median_latency:.2f}s'} "
+              f"| p90 latency {'-' if p90_latency is None else f'{p90_latency:.2f}s'}")
@@ -28,6 +28,7 @@ from PySide6.QtGui import QIcon, QAction
 import settings_menu
 import viewer_window
 import connections
+import mic_service
 from jarvis_process import jarvis_process, test_mic
 from jarvis_interrupter import stop_word_detection
 
@@ -93,6 +94,9 @@ class JarvisApp(QApplication):
         }
         self.codes = connections.get_connection_ring()
 
+        # Open the microphone once, every process reads it through the shared ring
+        mic_service.start_service()
+
         self.menu = QMenu()
 
         self.start_stop_action = QAction(self.config["start"], self)
@@ -276,6 +280,7 @@ class JarvisApp(QApplication):
         """Cleans up resources."""
         self._safe_kill()
         self.viewer.jarvis_waveform.force_close()
+        mic_service.stop_service()
         logger.info("Cleaning up resources")
         if self.message_queue is not None:
             self.message_queue.close()
@@ -1,5 +1,6 @@
 # Jarvis.spec
 # -*- mode: python ; coding: utf-8 -*-
+import importlib.util
 import os
 import platform
 import re
@@ -81,7 +82,15 @@ pico_models_list = [(os.path.join("pico_models", file), "pico_models") for file
 whisper_models_list = [(os.path.join("whisper_models", file), "whisper_models") for file in whisper_models_list]
 
 # Collect model data
-en_core_web_sm_data = collect_data_files('en_core_web_sm', include_py_files=True)
+# The spaCy model is only loaded by the "spacy" sentence segmenter, so it is left out unless that backend is configured
+with open("sentence_segmenter.py", "r") as f:
+    segmenter_backend = re.search(r'^segmenter_backend = "(\w+)"', f.read(), re.MULTILINE).group(1)
+if segmenter_backend == "spacy" and importlib.util.find_spec("en_core_web_sm") is not None:
+    en_core_web_sm_data = collect_data_files('en_core_web_sm', include_py_files=True)
+else:
+    if segmenter_backend == "spacy":
+        warnings.warn("segmenter_backend is spacy but en_core_web_sm is not installed, the rules will be used.")
+    en_core_web_sm_data = []
 pvp_data = collect_data_files('pvporcupine')
 pyside_core_datas = collect_data_files('PySide6.QtWebEngineCore', subdir='Qt/translations')
 whisper_datas = collect_data_files('whisper')
@@ -142,7 +151,12 @@ a = Analysis(
     ["jarvis.py", "audio_player.py", "internet_helper.py", "logger_config.py",
      "streaming_response_audio.py", "animation.py", "connections.py", "processor.py",
      "text_speech.py", "assistant_history.py", "jarvis_interrupter.py", "settings.py",
-     "viewer_window.py", "audio_listener.py", "gpt_interface.py", "jarvis_process.py", "settings_menu.py"],
+     "viewer_window.py", "audio_listener.py", "gpt_interface.py", "jarvis_process.py", "settings_menu.py",
+     "speech_model.py", "streaming_transcription.py", "audio_capture.py",
+     "endpointing.py", "audio_dsp.py", "stt_backends.py", "stt_worker.py", "dictation.py",
+     "audio_mixer.py",
+     "sentence_segmenter.py",
+     "mic_service.py"],
     pathex=[],
     binaries=torch_binaries + ffmpeg_binary + portaudio_binary,
     datas=data_files,
@@ -2,7 +2,7 @@ from pocketsphinx import LiveSpeech
 import pvporcupine
 import atexit
 from connections import ConnectionKeyError, get_pico_key, get_pico_stop_path
-from audio_player import start_audio_stream, stop_audio_stream, get_next_audio_frame
+from audio_player import start_audio_stream, stop_audio_stream, get_next_audio_frame, process_wake_frame
 
 import logger_config
 logger = logger_config.get_logger()
@@ -52,7 +52,7 @@ def stop_word_detection(stop_event, skip_event):
         while not stop_event.is_set():
             pcm = get_next_audio_frame(handle)
             if pcm is not None:
-                keyword_index = handle.process(pcm)
+                keyword_index = process_wake_frame(handle, pcm)
             if keyword_index >= 0:
                 logger.info("Stop word detected! Interrupting process...")
                 skip_event.set()
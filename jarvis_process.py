@@ -9,8 +9,11 @@ import atexit
 import threading
 import multiprocessing
 
-from audio_player import play_audio_file, get_next_audio_frame, start_audio_stream, stop_audio_stream
-from audio_listener import prep_mic, listen_to_user, convert_to_text
+from audio_player import play_audio_file, get_next_audio_frame, start_audio_stream, stop_audio_stream, preload_cues, \
+    process_wake_frame
+from audio_listener import prep_mic, listen_to_user, convert_to_text, start_streaming_transcription, \
+    track_ambient_noise
+from speech_model import preload_speech_model
 from connections import ConnectionKeyError, get_pico_key, get_pico_wake_path, get_gcp_data
 from processor import processor, get_model_name, get_chat_history
 from text_speech import text_to_speech
@@ -34,7 +37,7 @@ def check_tts(path: str) -> str:
     """
     global free_tts
     if free_tts:
-        path = re.sub("audio_files/", "audio_files_free/", path)
+        path = re.sub("^audio_files/", "free_audio_files/", path)
     return path
 
 
@@ -43,22 +46,23 @@ def jarvis_process(jarvis_stop_event: threading.Event, jarvis_skip_event: thread
     """
     Main function to run the Jarvis voice assistant process.
 
-    1. Initialize global variables and attempt to get GCP data. If unsuccessful, use the free text-to-speech service.
-    2. Set up wake word detection using either Porcupine (default) or Pocketsphinx (fallback).
-    3. Define a helper function graceful_skip_loop to handle user-requested skips gracefully.
-    4. Play an initial audio file as a tone.
-    5. Prepare the microphone and start the audio stream.
-    6. Enter the main loop that listens for the wake word and processes user input:
+    1. Start loading the speech to text model in the background and decode the cue sounds into memory.
+    2. Initialize global variables and attempt to get GCP data. If unsuccessful, use the free text-to-speech service.
+    3. Set up wake word detection using either Porcupine (default) or Pocketsphinx (fallback).
+    4. Define a helper function graceful_skip_loop to handle user-requested skips gracefully.
+    5. Play an initial audio file as a tone.
+    6. Prepare the microphone and start the audio stream.
+    7. Enter the main loop that listens for the wake word and processes user input:
         a. Set the system state to "standby" and listen for the wake word.
         b. If the wake word is detected, stop the audio stream and process the user input:
             i. Listen to the user's query.
             ii. Recognize the query and convert it to text.
             iii. Process the text query and generate a response.
             iv. Create an audio response using text-to-speech and play it back.
-            v. Prepare the microphone for the next round and set the system state to "standby."
-    7. Handle exceptions and errors at various levels, playing appropriate error audio files.
-    8. Perform cleanup, unregistering resources, and deleting the Porcupine handle if necessary.
-    9. Log that the Jarvis process has finished.
+            v. Set the system state to "standby." The energy threshold keeps tracking the standby audio.
+    8. Handle exceptions and errors at various levels, playing appropriate error audio files.
+    9. Perform cleanup, unregistering resources, and deleting the Porcupine handle if necessary.
+    10. Log that the Jarvis process has finished.
 
     :param jarvis_stop_event: threading.Event, the event to stop the process
     :param jarvis_skip_event: threading.Event, the event to skip the current process
@@ -74,6 +78,12 @@ def jarvis_process(jarvis_stop_event: threading.Event, jarvis_skip_event: thread
         if getattr(sys, 'frozen', False):
             logs_path = os.path.join(sys._MEIPASS, "logs")
 
+        # Load the speech to text model in the background while everything else boots
+        preload_speech_model()
+
+        # Decode the paid and free cue sounds once so they play straight from memory
+        preload_cues()
+
         # Attempt to get GCP data, if unsuccessful use free text-to-speech service
         try:
             get_gcp_data()
@@ -148,14 +158,15 @@ def jarvis_process(jarvis_stop_event: threading.Event, jarvis_skip_event: thread
                 else:
                     pcm = get_next_audio_frame(handle)
                     if pcm is not None:
-                        keyword_index = handle.process(pcm)
+                        keyword_index = process_wake_frame(handle, pcm)
+                        track_ambient_noise(pcm, handle.sample_rate)
                     if keyword_index >= 0:
                         detected = True
 
                 # Process user input if wake word detected
                 if detected:
                     detected = False
-                    stop_audio_stream()
+                    wake_position = stop_audio_stream()
 
                     try:
                         if graceful_skip_loop():
@@ -164,7 +175,8 @@ def jarvis_process(jarvis_stop_event: threading.Event, jarvis_skip_event: thread
                         # Listen to user query
                         logger.info("listening...")
                         queue.put("listening")
-                        query_audio = listen_to_user()
+                        transcriber = start_streaming_transcription()
+                        query_audio = listen_to_user(transcriber=transcriber, start_position=wake_position)
                         if graceful_skip_loop():
                             continue
                         queue.put("processing")
@@ -183,7 +195,10 @@ def jarvis_process(jarvis_stop_event: threading.Event, jarvis_skip_event: thread
                         try:
                             # Recognize user query
                             logger.info("Recognizing...")
-                            query = convert_to_text(query_audio)
+                            if transcriber is not None:
+                                query = transcriber.result()
+                            else:
+                                query = convert_to_text(query_audio)
                             text_queue.put({"role": "user", "content": query})
                             if graceful_skip_loop():
                                 continue
@@ -216,9 +231,7 @@ def jarvis_process(jarvis_stop_event: threading.Event, jarvis_skip_event: thread
                                 os.remove(audio_path)
                                 time.sleep(0.1)
 
-                        # Prepare microphone for next round
-                        logger.info("Adjusting mic...")
-                        prep_mic()
+                        # The energy threshold keeps tracking the standby audio, no need to recalibrate
                         queue.put("standby")
                         logger.info("Finished processing")
                         play_audio_file("audio_files/tone_one.wav", blocking=True)
@@ -260,6 +273,7 @@ def test_mic() -> None:
     :return: None
     """
     logger.info("Testing mic...")
+    preload_speech_model()
     try:
         handle = pvporcupine.create(access_key=get_pico_key(), keywords=['Jarvis'],
                                     keyword_paths=[get_pico_wake_path()])
@@ -0,0 +1,360 @@
+import atexit
+import time
+from multiprocessing import shared_memory
+from typing import Optional
+
+from numpy import ndarray, frombuffer, empty, int16, int64
+from pyaudio import PyAudio, paInt16, paContinue
+
+from audio_capture import choose_input_rate
+from audio_dsp import Resampler
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+# Configuration
+shared_memory_name = "jarvis_microphone"
+service_sample_rate = 16000  # Porcupine, Whisper and the endpointers all work at 16 kHz
+ring_seconds = 10  # How much audio subscribers can fall behind (or rewind) before frames are lost
+device_frames = 256  # Frames per device callback at the service rate, 16 ms
+read_timeout = 2.0  # Seconds a subscriber waits for audio before assuming the service is gone
+overrun_margin = 2 * device_frames  # Samples a subscriber keeps clear of the block the writer may be filling
+
+# Layout of the header at the start of the shared memory block
+header_slots = 8
+WRITE_POSITION = 0
+SAMPLE_RATE = 1
+CAPACITY = 2
+RUNNING = 3
+
+
+class MicrophoneServiceError(Exception):
+    """
+    Exception raised when the shared microphone is not delivering audio.
+    """
+
+    def __init__(self, reason):
+        """
+        Initialize the exception.
+
+        :param reason: What went wrong.
+        :type reason: str
+        """
+        self.reason = reason
+        super().__init__(f"The shared microphone is not available: {self.reason}")
+
+
+class MicrophoneService:
+    """
+    Owns the input device and publishes what it hears into a shared memory ring buffer.
+
+    The device is opened once, at 16 kHz if it supports it, and every callback is resampled if needed and copied into
+    the ring. Any number of MicrophoneSubscriber objects, in this or any other process, read from the ring with their
+    own position, so the wake word, stop word, listener and level meter all share one stream.
+
+    :param name: The name of the shared memory block.
+    :type name: str
+    :param seconds: The length of the ring in seconds.
+    :type seconds: float
+    """
+
+    def __init__(self, name: str = shared_memory_name, seconds: float = ring_seconds) -> None:
+        """
+        Initialize the service without opening the device.
+
+        :param name: The name of the shared memory block.
+        :type name: str
+        :param seconds: The length of the ring in seconds.
+        :type seconds: float
+        """
+        self.name = name
+        self.capacity = int(service_sample_rate * seconds)
+        self.memory = None
+        self.header = None
+        self.ring = None
+        self.p = None
+        self.stream = None
+        self.resampler = None
+
+    def start(self) -> None:
+        """
+        Create the shared ring and start capturing.
+        """
+        size = header_slots * 8 + self.capacity * 2
+        try:
+            self.memory = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            logger.warning(f"Removing stale shared microphone '{self.name}'.")
+            stale = shared_memory.SharedMemory(name=self.name)
+            stale.close()
+            stale.unlink()
+            self.memory = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        self.header = frombuffer(self.memory.buf, dtype=int64, count=header_slots)
+        self.ring = frombuffer(self.memory.buf, dtype=int16, count=self.capacity, offset=header_slots * 8)
+        self.header[:] = 0
+        self.header[SAMPLE_RATE] = service_sample_rate
+        self.header[CAPACITY] = self.capacity
+
+        self.p = PyAudio()
+        input_rate = choose_input_rate(self.p, service_sample_rate)
+        if input_rate != service_sample_rate:
+            logger.info(f"Microphone does not support {service_sample_rate} Hz, resampling from {input_rate} Hz.")
+            self.resampler = Resampler(input_rate, service_sample_rate)
+        self.header[RUNNING] = 1
+        self.stream = self.p.open(format=paInt16, channels=1, rate=input_rate, input=True,
+                                  frames_per_buffer=device_frames * input_rate // service_sample_rate,
+                                  stream_callback=self._callback)
+        logger.info("Shared microphone started.")
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        """
+        Copy a device buffer into the ring.
+
+        :param in_data: input data
+        :type in_data: bytes
+        :param frame_count: number of frames
+        :type frame_count: int
+        :param time_info: time information
+        :type time_info: dict
+        :param status: stream status
+        :type status: int
+        :return: stream status
+        :rtype: int
+        """
+        samples = frombuffer(in_data, dtype=int16)
+        if self.resampler is not None:
+            samples = self.resampler.process(samples)
+        self.write(samples)
+        return None, paContinue
+
+    def write(self, samples: ndarray) -> None:
+        """
+        Publish samples to the ring, then advance the write position so readers never see a partial write.
+
+        :param samples: int16 samples at the service rate.
+        :type samples: numpy.ndarray
+        """
+        position = int(self.header[WRITE_POSITION])
+        start = position % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.ring[start:start + first] = samples[:first]
+        self.ring[:len(samples) - first] = samples[first:]
+        self.header[WRITE_POSITION] = position + len(samples)
+
+    def stop(self) -> None:
+        """
+        Close the device and remove the shared ring.
+        """
+        if self.stream is not None:
+            try:
+                self.stream.stop_stream()
+                self.stream.close()
+            except Exception as e:
+                logger.error(f"Failed to stop the shared microphone: {e}")
+            self.stream = None
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
+        if self.memory is not None:
+            self.header[RUNNING] = 0
+            self.header = None
+            self.ring = None
+            self.memory.close()
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+            self.memory = None
+            logger.info("Shared microphone stopped.")
+
+
+class MicrophoneSubscriber:
+    """
+    Reads audio published by a MicrophoneService, from this or another process.
+
+    A new subscriber starts at the live edge of the stream. If it falls more than a ring behind, the oldest audio is
+    skipped and counted in dropped.
+
+    :param name: The name of the shared memory block.
+    :type name: str
+    """
+
+    def __init__(self, name: str = shared_memory_name) -> None:
+        """
+        Attach to the shared ring.
+
+        :param name: The name of the shared memory block.
+        :type name: str
+        """
+        self.memory = shared_memory.SharedMemory(name=name)
+        self.header = frombuffer(self.memory.buf, dtype=int64, count=header_slots)
+        self.capacity = int(self.header[CAPACITY])
+        self.sample_rate = int(self.header[SAMPLE_RATE])
+        self.ring = frombuffer(self.memory.buf, dtype=int16, count=self.capacity, offset=header_slots * 8)
+        self.position = int(self.header[WRITE_POSITION])
+        self.dropped = 0
+
+    def available(self) -> int:
+        """
+        Get the number of samples that can be read without waiting.
+
+        :return: The number of unread samples.
+        :rtype: int
+        """
+        return int(self.header[WRITE_POSITION]) - self.position
+
+    def read(self, frames: int, timeout: Optional[float] = read_timeout) -> ndarray:
+        """
+        Read the next frames, waiting for them to be captured if needed.
+
+        :param frames: The number of samples to read.
+        :type frames: int
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float, optional
+        :return: A copy of the samples.
+        :rtype: numpy.ndarray
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        poll = frames / self.sample_rate / 4
+        while self.available() < frames:
+            if not self.header[RUNNING]:
+                raise MicrophoneServiceError("the service has stopped")
+            if deadline is not None and time.time() > deadline:
+                raise MicrophoneServiceError(f"no audio for {timeout} seconds")
+            time.sleep(poll)
+
+        # The writer may be part way through a block it has not published yet, so stay that far clear of it
+        safe_capacity = self.capacity - overrun_margin
+        while True:
+            behind = self.available() - safe_capacity
+            if behind > 0:
+                self.dropped += behind
+                self.position += behind
+                logger.warning(f"Microphone subscriber fell behind, dropped {behind} samples.")
+
+            samples = self._copy(self.position, frames)
+            # If the writer lapped the span while it was being copied, skip what was lost and copy again
+            if self.available() <= safe_capacity:
+                break
+        self.position += frames
+        return samples
+
+    def latest(self, frames: int) -> ndarray:
+        """
+        Get the most recent frames without moving the read position, for level meters.
+
+        :param frames: The number of samples to return.
+        :type frames: int
+        :return: A copy of the samples.
+        :rtype: numpy.ndarray
+        """
+        frames = min(frames, self.capacity - overrun_margin)
+        return self._copy(max(int(self.header[WRITE_POSITION]) - frames, 0), frames)
+
+    def seek(self, position: int) -> int:
+        """
+        Move the read position, limited to the audio still held in the ring and the live edge.
+
+        :param position: The absolute position of the next sample to read.
+        :type position: int
+        :return: The position actually used.
+        :rtype: int
+        """
+        write_position = int(self.header[WRITE_POSITION])
+        self.position = min(max(position, write_position - self.capacity + overrun_margin, 0), write_position)
+        return self.position
+
+    def rewind(self, frames: int) -> int:
+        """
+        Move the read position back so audio captured before subscribing is read again, for pre-roll.
+
+        :param frames: The number of samples to go back.
+        :type frames: int
+        :return: The number of samples actually rewound.
+        :rtype: int
+        """
+        position = self.position
+        return position - self.seek(position - frames)
+
+    def skip_to_live(self) -> None:
+        """
+        Discard everything not read yet so the next read starts with fresh audio.
+        """
+        self.position = int(self.header[WRITE_POSITION])
+
+    def _copy(self, position: int, frames: int) -> ndarray:
+        """
+        Copy samples out of the ring, unwrapping them if they cross the end.
+
+        :param position: The absolute position of the first sample.
+        :type position: int
+        :param frames: The number of samples to copy.
+        :type frames: int
+        :return: The samples.
+        :rtype: numpy.ndarray
+        """
+        samples = empty(frames, dtype=int16)
+        start = position % self.capacity
+        first = min(frames, self.capacity - start)
+        samples[:first] = self.ring[start:start + first]
+        samples[first:] = self.ring[:frames - first]
+        return samples
+
+    def close(self) -> None:
+        """
+        Detach from the shared ring.
+        """
+        if self.memory is not None:
+            self.header = None
+            self.ring = None
+            self.memory.close()
+            self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+local_service = None
+
+
+def start_service() -> MicrophoneService:
+    """
+    Start the shared microphone for this process and everything it spawns.
+
+    :return: The running service.
+    :rtype: MicrophoneService
+    """
+    global local_service
+    if local_service is None:
+        local_service = MicrophoneService()
+        local_service.start()
+        atexit.register(stop_service)
+    return local_service
+
+
+def stop_service() -> None:
+    """
+    Stop the shared microphone if this process started it.
+    """
+    global local_service
+    if local_service is not None:
+        local_service.stop()
+        local_service = None
+
+
+def subscribe() -> MicrophoneSubscriber:
+    """
+    Subscribe to the shared microphone, starting it in this process if nobody else has.
+
+    :return: A subscriber positioned at the live edge of the stream.
+    :rtype: MicrophoneSubscriber
+    """
+    try:
+        return MicrophoneSubscriber()
+    except FileNotFoundError:
+        start_service()
+        return MicrophoneSubscriber()
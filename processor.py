@@ -11,6 +11,7 @@ from streaming_response_audio import stream_audio_response, set_rt_text_queue
 from internet_helper import create_internet_context
 from text_speech import text_to_speech
 from audio_player import play_audio_file
+from dictation import dictate
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -107,6 +108,20 @@ def internet_words_in(raw_query):
     return False
 
 
+def dictation_words_in(raw_query):
+    """
+    Check if the raw query asks Jarvis to take dictation.
+
+    Only a command at the start of the query counts, since a match records the user and emails the result, so a
+    question that merely mentions dictation or notes must not start a session.
+
+    :param raw_query: str, the raw query string
+    :return: bool, True if the query asks for dictation, False otherwise
+    """
+    command = r"^(please |can you |could you )?((take|start) (a |some )?dictation|take (down )?(a )?note)\b"
+    return re.match(command, raw_query.lstrip(" ,.!?")) is not None
+
+
 def last_response_words_in(raw_query):
     """
     Check if the raw query contains any words related to the last response.
@@ -150,6 +165,29 @@ def processor(raw_query, stop_audio_event, skip=None, text_queue=None):
         query, result = get_last_response()
         return email_processor("Jarvis responding to question: "+query['content'][:150]+"...", result['content'])
 
+    # Handle dictation, which is recorded until the user pauses for a while and then emailed
+    if dictation_words_in(test_str):
+        file = text_to_speech("Go ahead, I'm taking dictation. Pause for a few seconds when you are done.")
+        stop_audio_event.set()
+        play_audio_file(file, blocking=True, destroy=True, added_stop_event=skip)
+        if skip.is_set():
+            return "Sorry."
+        dictated = dictate(stop_event=skip)
+        if skip.is_set():
+            return "Sorry."
+        if not re.search('[a-zA-Z]', dictated):
+            return "I'm so sorry I didn't catch any of that."
+        output = email_processor("Jarvis dictation: " + dictated[:200]+"...", dictated)
+        if skip.is_set():
+            return "Sorry."
+        file = text_to_speech(output, model=get_model()['name'])
+        if skip.is_set():
+            return "Sorry."
+        play_audio_file(file, blocking=True, destroy=True, added_stop_event=skip)
+        if skip.is_set():
+            return "Sorry."
+        return output
+
     # Handle "the following" queries
     if test_str.find("the following") >= 0:
         # Handle emailing
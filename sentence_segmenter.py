@@ -0,0 +1,389 @@
+import argparse
+import json
+import random
+import re
+import time
+from typing import List, Optional
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+# Configuration
+segmenter_backend = "rules"  # "rules" needs nothing installed, "spacy" loads en_core_web_sm the first time it is used
+sentence_terminators = ".!?…"
+sentence_closers = "\"')]}”’"
+clause_break = re.compile(r"[,;:–—](?=\s)")
+# Words ending in a full stop that never end a sentence
+title_abbreviations = {"mr", "mrs", "ms", "dr", "prof", "st", "sr", "jr", "mt", "gen", "col", "lt", "sgt", "rev",
+                       "e.g", "i.e", "cf", "approx"}
+# Words ending in a full stop that only end a sentence if the next word is capitalised
+trailing_abbreviations = {"etc", "vs", "inc", "ltd", "co", "corp", "no", "vol", "ch", "fig", "jan", "feb", "mar", "apr",
+                          "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec", "a.m", "p.m", "u.s", "u.k"}
+
+# The spaCy pipeline, loaded by load_spacy the first time it is needed
+spacy_pipeline = None
+
+
+class SentenceSegmenter:
+    """
+    Splits streamed text into sentences as it arrives, only looking at the part after the last sentence it settled.
+
+    A boundary is a run of terminators followed by whitespace. It is only settled once the first character after
+    the whitespace has arrived, so a decimal point, a URL or an abbreviation is never split while its next token is
+    still on its way. Newlines always end a sentence.
+
+    If a spaCy pipeline with a sentencizer is given it is run over the unsettled tail instead of the rules, and
+    every sentence but the last one it finds is settled.
+
+    :param nlp: A spaCy pipeline to segment with instead of the rules.
+    :type nlp: spacy.language.Language, optional
+    """
+
+    def __init__(self, nlp=None) -> None:
+        """
+        Initialize the segmenter.
+
+        :param nlp: A spaCy pipeline to segment with instead of the rules.
+        :type nlp: spacy.language.Language, optional
+        """
+        self.nlp = nlp
+        self.tail = ""
+        self.scan = 0
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Add newly streamed text.
+
+        :param text: The next piece of the text.
+        :type text: str
+        :return: The sentences settled by this piece, in order.
+        :rtype: list of str
+        """
+        self.tail += text
+        if self.nlp is not None:
+            return self._feed_nlp()
+        sentences = []
+        while True:
+            end = self._next_boundary()
+            if end is None:
+                break
+            sentence = self.tail[:end].strip()
+            if sentence:
+                sentences.append(sentence)
+            self.tail = self.tail[end:]
+            self.scan = 0
+        return sentences
+
+    def flush(self) -> str:
+        """
+        Take whatever is left once the stream has ended.
+
+        :return: The unsettled text, stripped.
+        :rtype: str
+        """
+        rest = self.tail.strip()
+        self.tail = ""
+        self.scan = 0
+        return rest
+
+    def take_clause(self, min_characters: int = 0) -> Optional[str]:
+        """
+        Take the unsettled text up to its first clause break, a comma, semicolon, colon or dash followed by
+        whitespace, so speech can start before the sentence is complete.
+
+        :param min_characters: A break earlier than this is passed over, so the clause is not too short to speak.
+        :type min_characters: int
+        :return: The clause, stripped, or None if there is no break yet.
+        :rtype: str, optional
+        """
+        match = clause_break.search(self.tail, min_characters)
+        if match is None:
+            return None
+        return self._take(match.start() + 1)
+
+    def take_words(self) -> Optional[str]:
+        """
+        Take the unsettled text up to its last whitespace, leaving the word that may still be arriving.
+
+        :return: The words, stripped, or None if there is no whole word yet.
+        :rtype: str, optional
+        """
+        end = max(self.tail.rfind(" "), self.tail.rfind("\n"))
+        if end <= 0 or not self.tail[:end].strip():
+            return None
+        return self._take(end)
+
+    def _take(self, end: int) -> str:
+        """
+        Remove the start of the unsettled text.
+
+        :param end: The index to cut the unsettled text at.
+        :type end: int
+        :return: The text removed, stripped.
+        :rtype: str
+        """
+        taken = self.tail[:end].strip()
+        self.tail = self.tail[end:]
+        self.scan = max(self.scan - end, 0)
+        return taken
+
+    def _feed_nlp(self) -> List[str]:
+        """
+        Segment the unsettled tail with the spaCy pipeline.
+
+        :return: Every sentence found but the last, which may still grow.
+        :rtype: list of str
+        """
+        sentences = list(self.nlp(self.tail).sents)
+        if len(sentences) < 2:
+            return []
+        self.tail = self.tail[sentences[-1].start_char:]
+        return [sentence.text.strip() for sentence in sentences[:-1] if sentence.text.strip()]
+
+    def _next_boundary(self) -> Optional[int]:
+        """
+        Find the next settled sentence boundary in the tail, continuing from where the last search stopped.
+
+        :return: The index just after the boundary, or None if there is none yet.
+        :rtype: int, optional
+        """
+        tail = self.tail
+        length = len(tail)
+        i = self.scan
+        while i < length:
+            character = tail[i]
+            if character == "\n":
+                return i + 1
+            if character not in sentence_terminators:
+                i += 1
+                continue
+
+            end = i + 1
+            while end < length and (tail[end] in sentence_terminators or tail[end] in sentence_closers):
+                end += 1
+            following = end
+            while following < length and tail[following] in " \t":
+                following += 1
+            if following == length:
+                # The next character decides, wait for it
+                self.scan = i
+                return None
+            if following == end and tail[following] != "\n":
+                # "3.14", "example.com" or "e.g" carry on without a space
+                i = end
+                continue
+            if character == "." and end == i + 1 and not self._ends_sentence(tail, i, tail[following]):
+                i = end
+                continue
+            return end
+        self.scan = length
+        return None
+
+    @staticmethod
+    def _ends_sentence(tail: str, stop: int, next_character: str) -> bool:
+        """
+        Decide whether a single full stop followed by whitespace ends a sentence.
+
+        :param tail: The text being segmented.
+        :type tail: str
+        :param stop: The index of the full stop.
+        :type stop: int
+        :param next_character: The first character after the whitespace.
+        :type next_character: str
+        :return: True if it is a sentence boundary.
+        :rtype: bool
+        """
+        start = stop
+        while start > 0 and not tail[start - 1].isspace() and tail[start - 1] not in "(\"'“‘":
+            start -= 1
+        word = tail[start:stop].lower()
+        if next_character.islower():
+            return False
+        if word in title_abbreviations:
+            return False
+        if word in trailing_abbreviations:
+            return next_character.isupper()
+        if len(word) == 1 and word.isalpha():
+            # An initial, as in "J. R. R. Tolkien"
+            return False
+        if word.isdigit() and (start == 0 or tail[start - 1] == "\n"):
+            # A numbered list item, as in "1. Preheat the oven"
+            return False
+        return True
+
+
+def load_spacy():
+    """
+    Load the spaCy sentencizer pipeline the first time it is needed.
+
+    :return: The pipeline.
+    :rtype: spacy.language.Language
+    :raises ImportError: If spaCy or en_core_web_sm is not installed.
+    """
+    global spacy_pipeline
+    if spacy_pipeline is None:
+        import warnings
+        import en_core_web_sm
+        warnings.filterwarnings("ignore", category=UserWarning, module="spacy.pipeline.lemmatizer", lineno=211)
+        start = time.time()
+        nlp = en_core_web_sm.load(disable=["tagger", "parser", "ner"])
+        nlp.add_pipe("sentencizer")
+        spacy_pipeline = nlp
+        logger.info(f"Loaded the spaCy sentence segmenter in {time.time() - start:.2f}s.")
+    return spacy_pipeline
+
+
+def create_segmenter(backend: Optional[str] = None) -> SentenceSegmenter:
+    """
+    Create a segmenter for one streamed response.
+
+    :param backend: "rules" or "spacy", segmenter_backend if not given. If spaCy is not installed the rules are used.
+    :type backend: str, optional
+    :return: The segmenter.
+    :rtype: SentenceSegmenter
+    """
+    backend = backend or segmenter_backend
+    if backend == "spacy":
+        try:
+            return SentenceSegmenter(load_spacy())
+        except ImportError as e:
+            logger.warning(f"spaCy is not available, segmenting with the rules instead: {e}")
+    elif backend != "rules":
+        logger.warning(f"Unknown segmenter backend '{backend}', segmenting with the rules instead.")
+    return SentenceSegmenter()
+
+
+def resegment_whole_buffer(nlp, deltas: List[str]) -> List[str]:
+    """
+    Segment a token stream the way stream_audio_response used to, running the pipeline over the whole buffer of
+    unsent text on every delta. Kept as the baseline for the benchmark.
+
+    :param nlp: A spaCy pipeline with a sentencizer.
+    :type nlp: spacy.language.Language
+    :param deltas: The streamed pieces of text.
+    :type deltas: list of str
+    :return: The sentences.
+    :rtype: list of str
+    """
+    buffer = ""
+    settled = []
+    for delta in deltas:
+        buffer += delta
+        sentences = list(nlp(buffer).sents)
+        if len(sentences) > 1:
+            settled.extend(sentence.text.strip() for sentence in sentences[:-1])
+            buffer = sentences[-1].text
+    return settled + [buffer.strip()]
+
+
+def segment_stream(deltas: List[str], nlp=None) -> List[str]:
+    """
+    Segment a whole token stream with a SentenceSegmenter.
+
+    :param deltas: The streamed pieces of text.
+    :type deltas: list of str
+    :param nlp: A spaCy pipeline to segment with instead of the rules.
+    :type nlp: spacy.language.Language, optional
+    :return: The sentences.
+    :rtype: list of str
+    """
+    segmenter = SentenceSegmenter(nlp)
+    sentences = []
+    for delta in deltas:
+        sentences.extend(segmenter.feed(delta))
+    return sentences + [segmenter.flush()]
+
+
+def synthetic_stream(sentences: int, seed: int = 0) -> List[str]:
+    """
+    Build a response-like token stream, with abbreviations, decimals and URLs, split into pieces of 1 to 6
+    characters as a chat model streams them.
+
+    :param sentences: The number of sentences.
+    :type sentences: int
+    :param seed: The random seed.
+    :type seed: int
+    :return: The streamed pieces of text.
+    :rtype: list of str
+    """
+    templates = ["The forecast says it will be about {n}.5 degrees by noon.",
+                 "Dr. Smith recommends at least {n} glasses of water a day, e.g. with every meal.",
+                 "You can read more at https://example.com/page{n}.html if you like.",
+                 "Sure!",
+                 "That costs $1{n}.99, which is cheaper than last year.",
+                 "Traffic on the U.S. 101 is light right now, so the drive should take {n} minutes.",
+                 "Is there anything else I can help you with?"]
+    generator = random.Random(seed)
+    text = " ".join(generator.choice(templates).format(n=generator.randint(1, 9)) for _ in range(sentences))
+    deltas = []
+    i = 0
+    while i < len(text):
+        step = generator.randint(1, 6)
+        deltas.append(text[i:i + step])
+        i += step
+    return deltas
+
+
+def benchmark(streams: List[List[str]], repeats: int = 3) -> dict:
+    """
+    Measure the CPU time of segmenting token streams with the rules, incrementally with spaCy and with spaCy over
+    the whole buffer on every delta.
+
+    :param streams: Token streams, each a list of streamed pieces of text.
+    :type streams: list of list of str
+    :param repeats: How many times to replay every stream, the fastest run is kept.
+    :type repeats: int
+    :return: CPU seconds per approach, None for approaches that need spaCy if it is not installed.
+    :rtype: dict
+    """
+    try:
+        nlp = load_spacy()
+    except ImportError:
+        nlp = None
+
+    approaches = {"rules": lambda deltas: segment_stream(deltas),
+                  "spacy_incremental": lambda deltas: segment_stream(deltas, nlp),
+                  "spacy_whole_buffer": lambda deltas: resegment_whole_buffer(nlp, deltas)}
+    results = {}
+    for name, approach in approaches.items():
+        if nlp is None and name != "rules":
+            results[name] = None
+            continue
+        best = None
+        for _ in range(repeats):
+            start = time.process_time()
+            for deltas in streams:
+                approach(deltas)
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay streamed chat responses through the sentence segmenters "
+                                                 "and compare their CPU time.")
+    parser.add_argument("--streams", help="A JSONL file of recorded streams, each line a list of text deltas. "
+                                          "Synthetic responses are used if not given.", type=str, default=None)
+    parser.add_argument("--sentences", help="Sentences per synthetic response", type=str, default="5,20,80")
+    parser.add_argument("--repeats", help="Replays per approach, the fastest is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.streams:
+        with open(args.streams) as file:
+            workloads = {args.streams: [json.loads(line) for line in file if line.strip()]}
+    else:
+        workloads = {f"{count} sentences": [synthetic_stream(count, seed) for seed in range(10)]
+                     for count in (int(value) for value in args.sentences.split(","))}
+
+    print(f"{'workload':>14} | {'deltas':>7} | {'rules':>9} | {'spacy tail':>10} | {'spacy whole':>11}")
+    for label, workload in workloads.items():
+        result = benchmark(workload, args.repeats)
+        cells = [f"{result[name] * 1000:7.1f}ms" if result[name] is not None else "n/a"
+                 for name in ("rules", "spacy_incremental", "spacy_whole_buffer")]
+        print(f"{label:>14} | {sum(len(deltas) for deltas in workload):>7} | {cells[0]:>9} | {cells[1]:>10} | "
+              f"{cells[2]:>11}")
+    print("\nSample segmentation:")
+    for sentence in segment_stream(synthetic_stream(7, seed=1)):
+        print(f"  {sentence}")
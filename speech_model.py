@@ -0,0 +1,193 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+
+from numpy import zeros, float32
+
+from stt_backends import create_backend
+from stt_worker import ProcessBackend, SpeechWorkerError
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+# Configuration
+backend_name = "whisper"  # One of stt_backends.backends, "faster-whisper" or "whisper-int8" for CPU only machines
+model_name = "base.en"
+idle_timeout = 15 * 60  # Seconds a loaded model may sit unused before it is freed
+warm_up_seconds = 1.0
+use_worker_process = True  # Run the model in its own process so inference does not contend with audio for the GIL
+
+
+class SpeechModelManager:
+    """
+    Keeps one speech to text model resident so it is not reloaded from disk for every query.
+
+    The model is loaded on a background thread, warmed with a short silent decode and then handed to every caller
+    of use(). Once it has been idle for idle_timeout seconds it is freed and will be loaded again on the next use.
+
+    :param backend: The name of the speech to text backend to use.
+    :type backend: str
+    :param name: The name of the model to load.
+    :type name: str
+    :param idle: Seconds of inactivity before the model is freed, 0 or None to keep it forever.
+    :type idle: float
+    """
+
+    def __init__(self, backend: str = backend_name, name: str = model_name, idle: float = idle_timeout) -> None:
+        """
+        Initialize the manager without loading anything.
+
+        :param backend: The name of the speech to text backend to use.
+        :type backend: str
+        :param name: The name of the model to load.
+        :type name: str
+        :param idle: Seconds of inactivity before the model is freed, 0 or None to keep it forever.
+        :type idle: float
+        """
+        self.backend_name = backend
+        self.name = name
+        self.idle_timeout = idle
+        self.model = None
+        self.lock = threading.RLock()
+        self.loader = None
+        self.idle_timer = None
+        self.in_use = 0
+        self.last_used = time.time()
+
+    def preload(self) -> threading.Thread:
+        """
+        Start loading and warming the model in the background.
+
+        :return: The loader thread, which can be joined to wait for the model.
+        :rtype: threading.Thread
+        """
+        with self.lock:
+            if self.loader is None or not self.loader.is_alive():
+                self.loader = threading.Thread(target=self._load)
+                self.loader.daemon = True
+                self.loader.start()
+            return self.loader
+
+    def _load(self) -> None:
+        """
+        Load and warm the model if it is not already resident.
+        """
+        with self.lock:
+            if self.model is not None:
+                return
+            start = time.time()
+            if use_worker_process:
+                backend = ProcessBackend(self.backend_name, self.name)
+            else:
+                backend = create_backend(self.backend_name, self.name)
+            try:
+                backend.load()
+                backend.transcribe(zeros(int(16000 * warm_up_seconds), dtype=float32))
+            except Exception:
+                backend.unload()
+                raise
+            self.model = backend
+            self.last_used = time.time()
+            logger.info(f"{self.backend_name} model '{self.name}' loaded and warmed in {time.time() - start:.2f}s.")
+        self._schedule_release()
+
+    @contextmanager
+    def use(self):
+        """
+        Borrow the resident model, loading it first if needed.
+
+        The model will not be freed while it is borrowed.
+
+        :return: The loaded speech to text backend.
+        :rtype: stt_backends.SpeechToTextBackend
+        """
+        loader = self.loader
+        if loader is not None and loader.is_alive():
+            loader.join()
+        with self.lock:
+            if self.model is None:
+                logger.info("Speech to text model not resident, loading it now...")
+                self._load()
+            self.in_use += 1
+            model = self.model
+        try:
+            yield model
+        except SpeechWorkerError:
+            self._discard(model)
+            raise
+        finally:
+            with self.lock:
+                self.in_use -= 1
+                self.last_used = time.time()
+            self._schedule_release()
+
+    def _discard(self, model) -> None:
+        """
+        Drop a model whose worker process has failed, so the next use() starts a new one.
+
+        :param model: The backend that failed.
+        :type model: stt_backends.SpeechToTextBackend
+        """
+        with self.lock:
+            if self.model is not model:
+                return
+            logger.error(f"The {self.backend_name} worker failed, it will be restarted on the next use.")
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            self.model = None
+            model.unload()
+
+    def release(self) -> None:
+        """
+        Free the resident model.
+        """
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            if self.model is None:
+                return
+            self.model.unload()
+            self.model = None
+        gc.collect()
+        logger.info(f"{self.backend_name} model '{self.name}' released.")
+
+    def _schedule_release(self) -> None:
+        """
+        (Re)start the idle timer that frees the model.
+        """
+        if not self.idle_timeout:
+            return
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+            self.idle_timer = threading.Timer(self.idle_timeout, self._release_if_idle)
+            self.idle_timer.daemon = True
+            self.idle_timer.start()
+
+    def _release_if_idle(self) -> None:
+        """
+        Free the model if nobody has used it for idle_timeout seconds.
+
+        The check and the release happen under one hold of the lock, so use() cannot borrow the model in between.
+        """
+        with self.lock:
+            if self.in_use > 0 or time.time() - self.last_used < self.idle_timeout:
+                return
+            self.release()
+
+
+manager = SpeechModelManager()
+
+
+def preload_speech_model() -> threading.Thread:
+    """
+    Load the configured speech to text model in the background.
+
+    :return: The loader thread.
+    :rtype: threading.Thread
+    """
+    return manager.preload()
@@ -3,25 +3,24 @@ import sys
 import queue
 import threading
 import time
-import wave
-import io
-import warnings
 from queue import Queue
-from numpy import frombuffer, int16
-from pyaudio import PyAudio, paInt16
-import en_core_web_sm
 from typing import Iterator, Dict, Tuple, Optional
-from text_speech import text_to_speech, TextToSpeechError
+from text_speech import text_to_speech_chunks, TextToSpeechError
+from audio_mixer import get_mixer, mixer_rate
+from audio_player import cue_wait_margin
+from sentence_segmenter import create_segmenter
 
-warnings.filterwarnings("ignore", category=UserWarning, module="spacy.pipeline.lemmatizer", lineno=211)
-
-nlp = en_core_web_sm.load(disable=["tagger", "parser", "ner"])
-nlp.add_pipe("sentencizer")
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
 
 CHUNK = 8196
-FORMAT = paInt16
 CHANNELS = 1
-RATE = 16000
+synthesis_workers = 2  # Sentences synthesized at the same time, bounds the concurrent requests to the TTS API
+synthesis_lookahead = 4  # Sentences that may be synthesized ahead of the one playing
+first_utterance_policy = "clause"  # "clause" speaks the first clause as early as possible, "sentence" waits for one
+first_clause_min_characters = 20  # A comma earlier than this does not end the first clause
+first_utterance_max_tokens = 16  # Speak the words received so far after this many tokens even without a comma
 
 rt_text_queue_global = None
 
@@ -30,23 +29,29 @@ class SpeechStreamer:
     """
     A class for streaming text-to-speech audio.
 
+    Queued sentences are numbered and synthesized by a fixed pool of worker threads. The results are collected in a
+    reorder buffer and played strictly in the order they were queued, however long each one took to synthesize.
+
     :param stop_other_audio: A threading.Event() to stop any currently playing audio.
     :type stop_other_audio: threading.Event(), optional
     :param skip: A threading.Event() to skip the current audio stream.
     :type skip: threading.Event(), optional
     :param rt_queue: A queue to send real-time transcription data.
     :type rt_queue: queue.Queue(), optional
+    :param workers: The number of sentences synthesized at the same time.
+    :type workers: int, optional
+    :param lookahead: The number of sentences that may be synthesized ahead of the one playing.
+    :type lookahead: int, optional
     """
 
-    def __init__(self, stop_other_audio: threading.Event = None,
-                 skip: threading.Event = None, rt_queue: queue.Queue = None) -> None:
+    def __init__(self, stop_other_audio: threading.Event = None, skip: threading.Event = None,
+                 rt_queue: queue.Queue = None, workers: int = synthesis_workers,
+                 lookahead: int = synthesis_lookahead) -> None:
         """
         Initializes the SpeechStreamer class with default values.
 
-        The class instance is created with a queue for handling the text-to-speech
-        audio, and the corresponding thread is started to play the audio. The PyAudio
-        module is also used to initialize the class instance with parameters to control
-        the audio format and output.
+        The synthesis workers and the playback thread are started straight away. The
+        playback thread plays the audio through the shared output mixer.
 
         :param stop_other_audio: A threading.Event() to stop any currently playing audio.
         :type stop_other_audio: threading.Event(), optional
@@ -54,76 +59,150 @@ class SpeechStreamer:
         :type skip: threading.Event(), optional
         :param rt_queue: A queue to send real-time transcription data.
         :type rt_queue: queue.Queue(), optional
+        :param workers: The number of sentences synthesized at the same time.
+        :type workers: int, optional
+        :param lookahead: The number of sentences that may be synthesized ahead of the one playing.
+        :type lookahead: int, optional
         """
-        self.queue = queue.Queue()
+        self.texts = queue.Queue()
+        self.ready = {}
+        self.ready_condition = threading.Condition()
+        self.slots = threading.Semaphore(max(lookahead, 1))
         self.rt_queue = rt_queue
-        self.playing = False
-        self.thread = threading.Thread(target=self._play_audio, args=(stop_other_audio, skip))
-        self.thread.daemon = True
-        self.thread.start()
-        self.stream = None
-        self.py_audio = PyAudio()
+        self.sound = None
         self.stop_event = threading.Event()
         self.skip = skip
         self.audio_count = 0
+        self.sequence = 0
         self.lock = threading.Lock()
         self.done = False
+        self.start_time = time.time()
+        self.first_audio_seconds = None
+        self.workers = []
+        for _ in range(max(workers, 1)):
+            worker = threading.Thread(target=self._synthesize)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.thread = threading.Thread(target=self._play_audio, args=(stop_other_audio, skip))
+        self.thread.daemon = True
+        self.thread.start()
 
     def _play_audio(self, stop_other_audio: threading.Event = None,
                     skip: threading.Event = None) -> None:
         """
-        Plays the audio stream generated from the text-to-speech data.
+        Plays the synthesized sentences in the order they were queued.
 
-        The audio stream is played by iterating over the audio buffer chunk by chunk,
-        and writing each chunk to the PyAudio instance. The class instance is also
-        initialized with a threading.Lock() to prevent conflicts when accessing
-        the audio_count variable.
+        Every response is written chunk by chunk into one stream sound in the output
+        mixer, so consecutive sentences play back to back without reopening the device.
+        A sentence starts playing as soon as its first chunk has been synthesized and a
+        sentence that failed to synthesize is skipped without holding up the rest.
 
         :param stop_other_audio: A threading.Event() to stop any currently playing audio.
         :type stop_other_audio: threading.Event(), optional
         :param skip: A threading.Event() to skip the current audio stream.
         :type skip: threading.Event(), optional
         """
+        sequence = 0
         while True:
-            generator, sample_rate = self.queue.get()
-            if generator is None:
-                next
-            else:
+            with self.ready_condition:
+                while sequence not in self.ready:
+                    if (skip and skip.is_set()) or (self.done and sequence >= self.sequence):
+                        break
+                    self.ready_condition.wait(timeout=0.1)
+                item = self.ready.pop(sequence, None)
+            if item is None:
+                if skip and skip.is_set():
+                    self.stop()
+                return
+            text, model, audio = item
+            sequence += 1
+
+            if audio is not None:
+                generator, sample_rate = audio
                 if stop_other_audio:
                     stop_other_audio.set()
+                if self.sound is None or self.sound.rate != sample_rate:
+                    if self.sound is not None:
+                        self.sound.close()
+                    self.sound = get_mixer().open_stream(sample_rate, CHANNELS).stop_on(skip)
+                if self.rt_queue is not None:
+                    self.rt_queue.put({"role": "assistant", "content": text, "model": model})
+                for chunk in generator:
+                    if skip:
+                        if skip.is_set():
+                            self.stop()
+                            return
+                    self.sound.write(chunk)
+                    if self.first_audio_seconds is None:
+                        self.first_audio_seconds = time.time() - self.start_time
+                        logger.info(f"Time to first audio {self.first_audio_seconds:.2f}s with the {model} voice.")
+            self.slots.release()
+
+            with self.lock:
+                self.audio_count -= 1
+                if self.audio_count == 0 and self.done:
+                    self.stop_event.set()
+
+    def _synthesize(self) -> None:
+        """
+        Worker loop that synthesizes queued sentences into the reorder buffer.
 
-            if not self.playing:
-                self.playing = True
-                if self.stream is None:
-                    self.stream = self.py_audio.open(format=paInt16,
-                                                     channels=CHANNELS,
-                                                     rate=sample_rate,
-                                                     output=True,
-                                                     frames_per_buffer=CHUNK)
-            chunk_played = False
-            for chunk in generator:
-                if skip:
-                    if skip.is_set():
-                        self.stop()
-                        return
-                self.stream.write(chunk)
-                chunk_played = True
-
-            self.playing = False
-
-            if chunk_played:
-                with self.lock:
-                    self.audio_count -= 1
-                    if self.audio_count == 0 and self.done:
-                        self.stop_event.set()
+        A worker takes a lookahead slot before it takes a sentence, so the sentence the
+        playback thread is waiting for is never starved of a slot by later ones.
+        """
+        while True:
+            while not self.slots.acquire(timeout=0.1):
+                if self.skip is not None and self.skip.is_set():
+                    return
+            item = self.texts.get()
+            if item is None:
+                self.slots.release()
+                return
+            sequence, text, delay, model = item
+            published = False
+            chunks = queue.Queue()
+            try:
+                if self.skip is None or not self.skip.is_set():
+                    sample_rate, pcm = text_to_speech_chunks(text, model=model, chunk_frames=CHUNK)
+                    for chunk in pcm:
+                        chunks.put(chunk)
+                        if not published:
+                            # Playback can start while the rest of the sentence is synthesized
+                            time.sleep(delay)
+                            self._publish(sequence, (text, model, (iter(chunks.get, None), sample_rate)))
+                            published = True
+                        if self.skip is not None and self.skip.is_set():
+                            break
+            except TextToSpeechError as e:
+                logger.warning(f"Skipping a sentence that could not be synthesized: {e}")
+            except Exception as e:
+                logger.error(f"Text to speech failed: {e}")
+            finally:
+                chunks.put(None)
+                if not published:
+                    self._publish(sequence, (text, model, None))
+
+    def _publish(self, sequence: int, item: tuple) -> None:
+        """
+        Put a sentence into the reorder buffer and wake the playback thread.
+
+        :param sequence: The sentence's sequence number.
+        :type sequence: int
+        :param item: The text, the model and the chunk generator with its sample rate, or None if it failed.
+        :type item: tuple
+        """
+        with self.ready_condition:
+            self.ready[sequence] = item
+            self.ready_condition.notify_all()
 
     def queue_text(self, text: str, delay: float = 0, model: str = "gpt-4") -> None:
         """
         Queues the text data for text-to-speech processing.
 
-        The text data is queued and passed to the _process_text_to_speech() function to be
-        converted to audio. A threading.Lock() is used to prevent conflicts when accessing
-        the audio_count variable.
+        The text is numbered and handed to the synthesis workers, it is played after
+        every sentence queued before it. A threading.Lock() is used to prevent conflicts
+        when accessing the audio_count variable.
 
         :param text: The text data to be converted to speech.
         :type text: str
@@ -134,66 +213,39 @@ class SpeechStreamer:
         """
         with self.lock:
             self.audio_count += 1
-        tts_thread = threading.Thread(target=self._process_text_to_speech, args=(text, delay, model, self.rt_queue))
-        tts_thread.daemon = True
-        tts_thread.start()
+            sequence = self.sequence
+            self.sequence += 1
+        self.texts.put((sequence, text, delay, model))
 
     def stop(self) -> None:
         """
-        Stops the audio stream and PyAudio instance.
+        Waits for the queued audio to finish playing, or stops it if skipped.
 
-        The function stops the audio stream and PyAudio instance by closing the audio
-        stream and terminating the PyAudio instance. A threading.Event() is used to
-        ensure that the audio stream is stopped before closing the stream.
+        The function waits until every queued sentence has been written to the mixer,
+        then lets the stream sound drain. If the skip event is set the mixer fades the
+        sound out within one buffer instead.
 
         """
-        self.done = True
+        with self.lock:
+            if not self.done:
+                self.done = True
+                for _ in self.workers:
+                    self.texts.put(None)
+            if self.audio_count == 0:
+                self.stop_event.set()
         if self.skip is None:
             self.stop_event.wait()
         else:
             while self.stop_event.is_set() is False and self.skip.is_set() is False:
                 self.skip.wait(timeout=1)
-        if self.stream:
-            self.stream.stop_stream()
-            self.stream.close()
-        self.py_audio.terminate()
-
-    def _process_text_to_speech(self, text: str, delay: float, model: str, rt_text: queue.Queue) -> None:
-        """
-        Processes the text data into audio format.
-
-        The text data is passed to the text_to_speech() function for processing
-        and conversion into audio format. The audio data is then converted to a numpy array
-        and passed to the queue to be played as audio. The real-time transcription data
-        is also added to the queue.
-
-        :param text: The text data to be converted to speech.
-        :type text: str
-        :param delay: The delay time in seconds before playing the audio.
-        :type delay: float
-        :param model: The text-to-speech model to be used for conversion.
-        :type model: str
-        :param rt_text: A queue to send real-time transcription data.
-        :type rt_text: queue.Queue()
-        """
-        try:
-            byte_data = text_to_speech(text, stream=True, model=model)
-        except TextToSpeechError as e:
-            return
-        time.sleep(delay)
-        wav_io = io.BytesIO(byte_data)
-        with wave.open(wav_io, 'rb') as wav_file:
-            n_channels, sample_width, frame_rate, n_frames = wav_file.getparams()[:4]
-            audio_data = wav_file.readframes(n_frames)
-
-        # Convert audio data to numpy array
-        np_audio_data = frombuffer(audio_data, dtype=int16)
-
-        def generator():
-            for i in range(0, len(np_audio_data), CHUNK):
-                yield np_audio_data[i:i + CHUNK].tobytes()
-        rt_text.put({"role": "assistant", "content": text, "model": model})
-        self.queue.put((generator(), frame_rate))
+        if self.sound:
+            # The mixer fades the sound out itself within one buffer if the skip event is set
+            self.sound.close()
+            # Never wait on the mixer for much longer than the queued audio lasts
+            timeout = self.sound.pending() / mixer_rate + cue_wait_margin
+            if not self.sound.wait(timeout):
+                logger.warning(f"Spoken response did not finish within {timeout:.1f}s, stopping it.")
+                self.sound.stop(0)
 
 
 def stream_audio_response(streaming_text: Iterator[Dict], stop_audio_event: Optional[threading.Event] = None,
@@ -206,6 +258,10 @@ def stream_audio_response(streaming_text: Iterator[Dict], stop_audio_event: Opti
     to speech using the SpeechStreamer class. The real-time transcription data is
     passed to the global rt_text_queue_global variable.
 
+    With the "clause" first_utterance_policy the first clause is spoken as soon as it
+    is complete, or after first_utterance_max_tokens tokens, and the rest of the
+    response in whole sentences. The time to first audio is logged for every response.
+
     :param streaming_text: An iterator containing the streaming text data.
     :type streaming_text: Iterator[Dict]
     :param stop_audio_event: An event object to stop the audio stream, defaults to None.
@@ -217,11 +273,13 @@ def stream_audio_response(streaming_text: Iterator[Dict], stop_audio_event: Opti
     """
     global rt_text_queue_global
     speech_stream = SpeechStreamer(stop_other_audio=stop_audio_event, skip=skip, rt_queue=rt_text_queue_global)
-    buffer = ""
+    segmenter = create_segmenter()
+    held = None
     output = ""
     resp = None
-    delay = 0.5
     model = None
+    tokens = 0
+    first_spoken = first_utterance_policy != "clause"
     for resp in streaming_text:
         if skip:
             if skip.is_set():
@@ -231,37 +289,34 @@ def stream_audio_response(streaming_text: Iterator[Dict], stop_audio_event: Opti
                 model = resp['model']
             if "content" in resp["choices"][0]["delta"]:
                 text = resp["choices"][0]["delta"]["content"]
-                buffer += text
                 output += text
-                doc = nlp(buffer)
-                sentences = list(doc.sents)
-
-                if len(sentences) > 1:
-                    merged_sentences = []
-                    i = 0
-                    while i < len(sentences) - 1:
-                        current_sentence = sentences[i].text.strip()
-                        next_sentence = sentences[i + 1].text.strip()
-
-                        if len(current_sentence) < 50:
-                            current_sentence += " " + next_sentence
-                            i += 2
-                        else:
-                            i += 1
-                        merged_sentences.append(current_sentence)
-
-                    if i == len(sentences) - 1:
-                        merged_sentences.append(sentences[-1].text.strip())
-
-                    for sentence in merged_sentences[:-1]:
-                        speech_stream.queue_text(sentence, delay=delay, model=model)
-                        delay = 0
-
-                    # Keep the last part (which may be an incomplete sentence) in the buffer
-                    buffer = merged_sentences[-1]
+                tokens += 1
+                sentences = segmenter.feed(text)
+                if not first_spoken:
+                    # Speak the first clause as soon as it is complete, then whole sentences
+                    if sentences:
+                        first = sentences.pop(0)
+                    else:
+                        first = segmenter.take_clause(first_clause_min_characters)
+                        if first is None and tokens >= first_utterance_max_tokens:
+                            first = segmenter.take_words()
+                    if first:
+                        speech_stream.queue_text(first, model=model)
+                        first_spoken = True
+                for sentence in sentences:
+                    # Short sentences are spoken together with the next one
+                    if held is not None:
+                        speech_stream.queue_text(held + " " + sentence, model=model)
+                        held = None
+                    elif len(sentence) < 50:
+                        held = sentence
+                    else:
+                        speech_stream.queue_text(sentence, model=model)
     if skip:
         if skip.is_set():
             return "Sorry.", "null"
+    # Keep the last part, which may be an incomplete sentence, for the final chunk
+    buffer = " ".join(part for part in (held, segmenter.flush()) if part)
     if resp:
         reason = resp["choices"][0]["finish_reason"]
     else:
@@ -276,7 +331,7 @@ def stream_audio_response(streaming_text: Iterator[Dict], stop_audio_event: Opti
         if reason == "content_filter":
             buffer += "I am so sorry, but if I responded to that I would have been forced to say something naughty."
             output += "I am so sorry, but if I responded to that I would have been forced to say something naughty."
-    speech_stream.queue_text(buffer)
+    speech_stream.queue_text(buffer, model=model or "gpt-4")
     speech_stream.stop()
     return output, reason
 
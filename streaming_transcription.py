@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+from typing import Optional
+
+from numpy import ndarray, concatenate, sqrt, mean, square, argmin
+
+from speech_model import manager
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+# Configuration
+sample_rate = 16000
+window_seconds = 8.0  # Length of audio collected before a window is closed and transcribed
+cut_search_seconds = 1.5  # How far back from the end of a window to look for a quiet place to cut
+cut_frame_seconds = 0.02
+prompt_characters = 200  # How much of the transcript so far is passed to Whisper as context
+
+
+class StreamingTranscriber:
+    """
+    Transcribes audio in closed windows on a worker thread while it is still being recorded.
+
+    Audio is fed in as float32 samples at 16 kHz. Every time window_seconds of audio has been collected the window
+    is cut at the quietest point near its end and handed to the worker, so by the time the user stops talking only
+    the tail is left to decode.
+
+    :param window: Seconds of audio per closed window.
+    :type window: float
+    """
+
+    def __init__(self, window: float = window_seconds) -> None:
+        """
+        Initialize the transcriber and start its worker thread.
+
+        :param window: Seconds of audio per closed window.
+        :type window: float
+        """
+        self.window_samples = int(window * sample_rate)
+        self.pending = []
+        self.pending_samples = 0
+        self.windows = queue.Queue()
+        self.texts = []
+        self.error = None
+        self.finished = False
+        self.finish_time = None
+        self.thread = threading.Thread(target=self._transcribe_windows)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self, audio: ndarray) -> None:
+        """
+        Add newly captured audio, closing a window if enough has been collected.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        """
+        if self.finished or len(audio) == 0:
+            return
+        self.pending.append(audio)
+        self.pending_samples += len(audio)
+        if self.pending_samples >= self.window_samples:
+            window = concatenate(self.pending)
+            cut = find_quiet_cut(window)
+            self.windows.put(window[:cut])
+            remainder = window[cut:]
+            self.pending = [remainder] if len(remainder) else []
+            self.pending_samples = len(remainder)
+
+    def finish(self, trailing_silence: int = 0) -> None:
+        """
+        Hand the remaining tail to the worker. Does not wait for the transcript.
+
+        :param trailing_silence: The number of samples at the end of what was fed that hold no speech and can be
+            dropped, if they have not been handed to the worker yet.
+        :type trailing_silence: int
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.finish_time = time.time()
+        keep = self.pending_samples - trailing_silence
+        if keep > 0:
+            self.windows.put(concatenate(self.pending)[:keep])
+        self.pending = []
+        self.pending_samples = 0
+        self.windows.put(None)
+
+    def partial_text(self) -> str:
+        """
+        Get the transcript of the windows decoded so far without waiting.
+
+        :return: The partial transcript.
+        :rtype: str
+        """
+        return " ".join(self.texts).strip()
+
+    def result(self, timeout: Optional[float] = None) -> str:
+        """
+        Wait for every window to be transcribed and return the full transcript.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float, optional
+        :return: The transcript of everything fed so far.
+        :rtype: str
+        """
+        self.finish()
+        self.thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        logger.info(f"Streaming transcript ready {time.time() - self.finish_time:.2f}s after end of speech.")
+        return " ".join(self.texts).strip()
+
+    def _transcribe_windows(self) -> None:
+        """
+        Worker loop that transcribes closed windows in order.
+        """
+        while True:
+            window = self.windows.get()
+            if window is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                prompt = " ".join(self.texts)[-prompt_characters:] or None
+                with manager.use() as model:
+                    self.texts.append(model.transcribe(window, prompt=prompt).strip())
+            except Exception as e:
+                logger.error(f"Streaming transcription failed: {e}")
+                self.error = e
+
+
+def find_quiet_cut(window: ndarray) -> int:
+    """
+    Find the quietest place near the end of a window so a word is not split between two windows.
+
+    :param window: float32 samples at 16 kHz.
+    :type window: numpy.ndarray
+    :return: The sample index to cut the window at.
+    :rtype: int
+    """
+    frame = int(cut_frame_seconds * sample_rate)
+    search = min(int(cut_search_seconds * sample_rate), len(window)) // frame * frame
+    if search == 0:
+        return len(window)
+    start = len(window) - search
+    frames = window[start:].reshape(-1, frame)
+    energy = sqrt(mean(square(frames), axis=1))
+    return start + int(argmin(energy)) * frame + frame // 2
+
@@ -0,0 +1,224 @@
+import os
+import sys
+from typing import Optional
+
+from numpy import ndarray, float32
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+
+def get_model_dir() -> str:
+    """
+    Get the folder the speech to text models are stored in.
+
+    :return: The path to the whisper_models folder.
+    :rtype: str
+    """
+    dir_path = "whisper_models"
+    if getattr(sys, 'frozen', False):
+        dir_path = os.path.join(sys._MEIPASS, "whisper_models")
+    return dir_path
+
+
+class SpeechToTextBackend:
+    """
+    Base class for the engines that turn 16 kHz float32 audio into text.
+
+    :param model_name: The name of the model to load, for example "base.en".
+    :type model_name: str
+    """
+
+    def __init__(self, model_name: str) -> None:
+        """
+        Initialize the backend without loading anything.
+
+        :param model_name: The name of the model to load.
+        :type model_name: str
+        """
+        self.model_name = model_name
+        self.model = None
+
+    def load(self) -> None:
+        """
+        Load the model into memory.
+        """
+        raise NotImplementedError
+
+    def transcribe(self, audio: ndarray, prompt: Optional[str] = None) -> str:
+        """
+        Transcribe a clip.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        :param prompt: Text that came before the clip, used as context.
+        :type prompt: str, optional
+        :return: The transcript.
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def unload(self) -> None:
+        """
+        Drop the model so its memory can be freed.
+        """
+        self.model = None
+
+    def is_loaded(self) -> bool:
+        """
+        Check whether the model is in memory.
+
+        :return: True if the model is loaded.
+        :rtype: bool
+        """
+        return self.model is not None
+
+
+class WhisperBackend(SpeechToTextBackend):
+    """
+    The reference openai-whisper engine, using fp16 when a GPU is available.
+    """
+
+    def load(self) -> None:
+        """
+        Load the model into memory.
+        """
+        import whisper
+        self.model = whisper.load_model(self.model_name, download_root=get_model_dir())
+
+    def transcribe(self, audio: ndarray, prompt: Optional[str] = None) -> str:
+        """
+        Transcribe a clip.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        :param prompt: Text that came before the clip, used as context.
+        :type prompt: str, optional
+        :return: The transcript.
+        :rtype: str
+        """
+        from torch.cuda import is_available
+        result = self.model.transcribe(audio.astype(float32, copy=False), fp16=is_available(), initial_prompt=prompt)
+        return result["text"]
+
+    def unload(self) -> None:
+        """
+        Drop the model and release any GPU memory it held.
+        """
+        from torch.cuda import is_available, empty_cache
+        self.model = None
+        if is_available():
+            empty_cache()
+
+
+class QuantizedWhisperBackend(WhisperBackend):
+    """
+    openai-whisper on the CPU with its linear layers dynamically quantized to int8 by torch.
+
+    openai-whisper builds its layers from its own subclass of torch.nn.Linear, which torch's dynamic quantization
+    only matches by exact type, so they are swapped for plain torch.nn.Linear layers sharing the same weights first.
+    """
+
+    def load(self) -> None:
+        """
+        Load the model on the CPU and quantize it.
+        """
+        import torch
+        import whisper
+        model = whisper.load_model(self.model_name, device="cpu", download_root=get_model_dir())
+        self._use_plain_linear(model)
+        self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        quantized = sum(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in self.model.modules())
+        if quantized == 0:
+            logger.warning(f"No layers of '{self.model_name}' were quantized, it will run in float32.")
+        else:
+            logger.info(f"Quantized {quantized} linear layers of '{self.model_name}' to int8.")
+
+    @staticmethod
+    def _use_plain_linear(model) -> None:
+        """
+        Replace every subclass of torch.nn.Linear in a model with a torch.nn.Linear holding the same parameters.
+
+        :param model: The model to change in place.
+        :type model: torch.nn.Module
+        """
+        import torch
+        replacements = []
+        for parent in model.modules():
+            for name, child in parent.named_children():
+                if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+                    replacements.append((parent, name, child))
+        for parent, name, child in replacements:
+            linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None, device="meta")
+            linear.weight = child.weight
+            linear.bias = child.bias
+            setattr(parent, name, linear)
+
+    def transcribe(self, audio: ndarray, prompt: Optional[str] = None) -> str:
+        """
+        Transcribe a clip.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        :param prompt: Text that came before the clip, used as context.
+        :type prompt: str, optional
+        :return: The transcript.
+        :rtype: str
+        """
+        result = self.model.transcribe(audio.astype(float32, copy=False), fp16=False, initial_prompt=prompt)
+        return result["text"]
+
+
+class FasterWhisperBackend(SpeechToTextBackend):
+    """
+    The CTranslate2 engine from faster-whisper running int8 on the CPU.
+
+    faster-whisper is optional, it is only imported when this backend is selected.
+    """
+
+    compute_type = "int8"
+    cpu_threads = 0  # 0 lets CTranslate2 pick
+
+    def load(self) -> None:
+        """
+        Load the model into memory.
+        """
+        from faster_whisper import WhisperModel
+        self.model = WhisperModel(self.model_name, device="cpu", compute_type=self.compute_type,
+                                  cpu_threads=self.cpu_threads, download_root=get_model_dir())
+
+    def transcribe(self, audio: ndarray, prompt: Optional[str] = None) -> str:
+        """
+        Transcribe a clip.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        :param prompt: Text that came before the clip, used as context.
+        :type prompt: str, optional
+        :return: The transcript.
+        :rtype: str
+        """
+        segments, _ = self.model.transcribe(audio.astype(float32, copy=False), beam_size=5, initial_prompt=prompt)
+        return "".join(segment.text for segment in segments)
+
+
+backends = {"whisper": WhisperBackend,
+            "whisper-int8": QuantizedWhisperBackend,
+            "faster-whisper": FasterWhisperBackend}
+
+
+def create_backend(name: str, model_name: str) -> SpeechToTextBackend:
+    """
+    Create a speech to text backend by name.
+
+    :param name: The name of the backend, one of the keys of backends.
+    :type name: str
+    :param model_name: The name of the model the backend should load.
+    :type model_name: str
+    :return: The new, unloaded backend.
+    :rtype: SpeechToTextBackend
+    """
+    if name not in backends:
+        raise ValueError(f"Unknown speech to text backend '{name}', expected one of {list(backends)}.")
+    return backends[name](model_name)
@@ -0,0 +1,121 @@
+import argparse
+import os
+import re
+import time
+
+from numpy import ndarray, float32, zeros
+from soundfile import read
+
+from audio_dsp import resample
+from stt_backends import backends, create_backend
+
+# Parse input arguments
+parser = argparse.ArgumentParser(
+    description="Report the real time factor and word error rate of the speech to text backends on a fixed clip set. "
+                "Every clip.wav (or .flac) in the folder needs a clip.txt next to it with the reference transcript.")
+parser.add_argument(
+    "folder",
+    help="The folder of clips and reference transcripts",
+    type=str
+)
+parser.add_argument(
+    "--backends",
+    help="Comma separated backends to compare, defaults to all of " + ", ".join(backends),
+    type=str,
+    default=",".join(backends)
+)
+parser.add_argument(
+    "--model",
+    help="The model every backend should load",
+    type=str,
+    default="base.en"
+)
+
+
+def normalize(text: str) -> list:
+    """
+    Lower case a transcript and split it into words without punctuation.
+
+    :param text: The transcript.
+    :type text: str
+    :return: The words.
+    :rtype: list
+    """
+    return re.sub(r"[^a-z0-9' ]", " ", text.lower()).split()
+
+
+def word_error_rate(reference: str, hypothesis: str) -> tuple:
+    """
+    Count the word level edits between a reference and a hypothesis.
+
+    :param reference: The reference transcript.
+    :type reference: str
+    :param hypothesis: The transcript to score.
+    :type hypothesis: str
+    :return: The number of substitutions, insertions and deletions, and the number of reference words.
+    :rtype: tuple
+    """
+    ref = normalize(reference)
+    hyp = normalize(hypothesis)
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i] + [0] * len(hyp)
+        for j, hyp_word in enumerate(hyp, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word))
+        previous = current
+    return previous[-1], len(ref)
+
+
+def load_clip(path: str) -> ndarray:
+    """
+    Load a clip as mono float32 at 16 kHz.
+
+    :param path: The path to the clip.
+    :type path: str
+    :return: The samples.
+    :rtype: numpy.ndarray
+    """
+    audio, sample_rate = read(path, dtype="float32")
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1).astype(float32)
+    return resample(audio, sample_rate, 16000)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    clips = []
+    for file in sorted(os.listdir(args.folder)):
+        name, extension = os.path.splitext(file)
+        reference_path = os.path.join(args.folder, name + ".txt")
+        if extension.lower() in (".wav", ".flac") and os.path.exists(reference_path):
+            with open(reference_path, "r") as reference_file:
+                clips.append((load_clip(os.path.join(args.folder, file)), reference_file.read()))
+    audio_seconds = sum(len(audio) for audio, _ in clips) / 16000
+    print(f"{len(clips)} clips, {audio_seconds:.1f}s of audio\n")
+
+    print(f"{'backend':>15} | {'load':>7} | {'RTF':>6} | {'WER':>6}")
+    for backend_name in args.backends.split(","):
+        backend = create_backend(backend_name.strip(), args.model)
+        start = time.perf_counter()
+        try:
+            backend.load()
+        except ImportError as e:
+            print(f"{backend_name:>15} | skipped, {e}")
+            continue
+        load_seconds = time.perf_counter() - start
+        backend.transcribe(zeros(16000, dtype=float32))
+
+        errors = 0
+        words = 0
+        decode_seconds = 0.0
+        for audio, reference in clips:
+            start = time.perf_counter()
+            hypothesis = backend.transcribe(audio)
+            decode_seconds += time.perf_counter() - start
+            clip_errors, clip_words = word_error_rate(reference, hypothesis)
+            errors += clip_errors
+            words += clip_words
+        backend.unload()
+        real_time_factor = decode_seconds / audio_seconds if audio_seconds else 0.0
+        error_rate = errors / words if words else 0.0
+        print(f"{backend_name:>15} | {load_seconds:6.2f}s | {real_time_factor:6.3f} | {error_rate:6.1%}")
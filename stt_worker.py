@@ -0,0 +1,257 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing import shared_memory
+from typing import Optional
+
+from numpy import ndarray, frombuffer, float32
+
+from stt_backends import SpeechToTextBackend, create_backend
+
+# Configure logging
+import logger_config
+logger = logger_config.get_logger()
+
+# Configuration
+worker_threads = max(1, (os.cpu_count() or 2) // 2)  # torch threads, the rest are left for the audio threads
+worker_niceness = 5  # Added to the worker's nice value so audio always wins the CPU
+initial_capacity_seconds = 30  # The shared audio block grows if a clip is longer
+start_timeout = 120.0  # Seconds to wait for the worker to load its model
+
+
+class SpeechWorkerError(Exception):
+    """
+    Exception raised when the speech to text worker process fails or goes away.
+    """
+
+    def __init__(self, reason):
+        """
+        Initialize the exception.
+
+        :param reason: What went wrong.
+        :type reason: str
+        """
+        self.reason = reason
+        super().__init__(f"The speech to text worker failed: {self.reason}")
+
+
+def limit_threads(threads: int) -> None:
+    """
+    Pin the number of threads the inference libraries may use in this process.
+
+    :param threads: The number of threads.
+    :type threads: int
+    """
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+
+
+def worker_main(connection, backend_name: str, model_name: str, threads: int) -> None:
+    """
+    Entry point of the worker process: load the model once, then answer transcription requests until told to stop.
+
+    Requests are ("transcribe", shared memory name, number of samples, prompt) tuples and each gets an ("ok", text)
+    or ("error", message) reply.
+
+    :param connection: The worker's end of the pipe.
+    :type connection: multiprocessing.connection.Connection
+    :param backend_name: The name of the speech to text backend.
+    :type backend_name: str
+    :param model_name: The name of the model to load.
+    :type model_name: str
+    :param threads: The number of inference threads.
+    :type threads: int
+    """
+    limit_threads(threads)
+    try:
+        os.nice(worker_niceness)
+    except (AttributeError, OSError):
+        pass
+
+    try:
+        backend = create_backend(backend_name, model_name)
+        backend.load()
+    except Exception as e:
+        connection.send(("error", str(e)))
+        return
+    connection.send(("ok", None))
+
+    memory = None
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request[0] == "stop":
+            break
+        _, name, length, prompt = request
+        try:
+            if memory is None or memory.name != name:
+                if memory is not None:
+                    memory.close()
+                memory = shared_memory.SharedMemory(name=name)
+            audio = frombuffer(memory.buf, dtype=float32, count=length).copy()
+            text = backend.transcribe(audio, prompt=prompt)
+            connection.send(("ok", text))
+        except Exception as e:
+            connection.send(("error", str(e)))
+    if memory is not None:
+        memory.close()
+    backend.unload()
+
+
+class ProcessBackend(SpeechToTextBackend):
+    """
+    Runs another backend in a long lived worker process so inference never holds this process's GIL.
+
+    Audio is copied into a shared memory block and only its length and the prompt go over the pipe; the text comes
+    back the same way. The worker pins its inference threads and lowers its priority so it cannot starve the audio
+    threads. Loading starts the process and unloading stops it, so the model manager's idle timer frees everything.
+
+    :param backend_name: The name of the backend the worker should run.
+    :type backend_name: str
+    :param model_name: The name of the model to load.
+    :type model_name: str
+    :param threads: The number of inference threads in the worker.
+    :type threads: int
+    """
+
+    def __init__(self, backend_name: str, model_name: str, threads: int = worker_threads) -> None:
+        """
+        Initialize the backend without starting the worker.
+
+        :param backend_name: The name of the backend the worker should run.
+        :type backend_name: str
+        :param model_name: The name of the model to load.
+        :type model_name: str
+        :param threads: The number of inference threads in the worker.
+        :type threads: int
+        """
+        super().__init__(model_name)
+        self.backend_name = backend_name
+        self.threads = threads
+        self.connection = None
+        self.memory = None
+        self.capacity = 0
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        Start the worker and wait for its model to be loaded.
+        """
+        # Spawned rather than forked, a fork would copy this process while its audio threads hold locks
+        context = multiprocessing.get_context("spawn")
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(target=worker_main, daemon=True,
+                                  args=(child_connection, self.backend_name, self.model_name, self.threads))
+        process.start()
+        child_connection.close()
+        self.connection = parent_connection
+        self.model = process
+        self._receive(start_timeout)
+        self._ensure_capacity(int(16000 * initial_capacity_seconds))
+        logger.info(f"Speech to text worker {process.pid} running {self.backend_name} on {self.threads} threads.")
+
+    def transcribe(self, audio: ndarray, prompt: Optional[str] = None) -> str:
+        """
+        Transcribe a clip in the worker.
+
+        :param audio: float32 samples at 16 kHz.
+        :type audio: numpy.ndarray
+        :param prompt: Text that came before the clip, used as context.
+        :type prompt: str, optional
+        :return: The transcript.
+        :rtype: str
+        """
+        with self.lock:
+            self._ensure_capacity(len(audio))
+            frombuffer(self.memory.buf, dtype=float32, count=len(audio))[:] = audio
+            self._send(("transcribe", self.memory.name, len(audio), prompt))
+            return self._receive()
+
+    def unload(self) -> None:
+        """
+        Stop the worker and remove the shared audio block.
+        """
+        with self.lock:
+            if self.model is not None:
+                try:
+                    self.connection.send(("stop",))
+                except (BrokenPipeError, OSError):
+                    pass
+                self.model.join(5)
+                if self.model.is_alive():
+                    self.model.terminate()
+                self.connection.close()
+                self.connection = None
+                self.model = None
+            if self.memory is not None:
+                self._free_memory()
+
+    def _ensure_capacity(self, length: int) -> None:
+        """
+        Make sure the shared audio block can hold a clip, doubling it if it cannot.
+
+        :param length: The number of samples needed.
+        :type length: int
+        """
+        if length <= self.capacity:
+            return
+        capacity = max(length, self.capacity * 2)
+        if self.memory is not None:
+            self._free_memory()
+        self.memory = shared_memory.SharedMemory(create=True, size=max(capacity, 1) * 4)
+        self.capacity = capacity
+
+    def _free_memory(self) -> None:
+        """
+        Close and remove the shared audio block.
+        """
+        self.memory.close()
+        try:
+            self.memory.unlink()
+        except FileNotFoundError:
+            pass
+        self.memory = None
+        self.capacity = 0
+
+    def _send(self, message: tuple) -> None:
+        """
+        Send a request to the worker.
+
+        :param message: The request.
+        :type message: tuple
+        """
+        try:
+            self.connection.send(message)
+        except (BrokenPipeError, OSError) as e:
+            raise SpeechWorkerError(f"could not reach the worker: {e}")
+
+    def _receive(self, timeout: Optional[float] = None):
+        """
+        Wait for the worker's reply.
+
+        :param timeout: The maximum number of seconds to wait, None to wait as long as the worker is alive.
+        :type timeout: float, optional
+        :return: The value sent back by the worker.
+        """
+        waited = 0.0
+        while not self.connection.poll(1.0):
+            waited += 1.0
+            if not self.model.is_alive():
+                raise SpeechWorkerError(f"the worker exited with code {self.model.exitcode}")
+            if timeout is not None and waited >= timeout:
+                raise SpeechWorkerError(f"no reply after {timeout} seconds")
+        try:
+            status, value = self.connection.recv()
+        except EOFError:
+            raise SpeechWorkerError("the worker closed the pipe")
+        if status == "error":
+            raise SpeechWorkerError(value)
+        return value
@@ -10,11 +10,17 @@ from pydub import AudioSegment
 import uuid
 import io
 import re
+import wave
+from typing import Iterator, Tuple
 
 # Setup logging
 import logger_config
 logger = logger_config.get_logger()
 
+# Configuration
+stream_sample_rate = 24000  # Rate of the chunks from text_to_speech_chunks, the output mixer's rate
+say_sample_rate = 22050
+
 # Load service account credentials and instantiate a Text-to-Speech client
 try:
     sa_creds = service_account.Credentials.from_service_account_info(get_gcp_data())
@@ -62,23 +68,8 @@ def text_to_speech(text: str, stream=False, model="gpt-4"):
     # Set the text input to be synthesized
     synthesis_input = texttospeech.SynthesisInput(text=text)
 
-    # Build the voice request, select the language code ("en-GB") and the voice
-    # name ("en-GB-Neural2-B")
-    if model.find("gpt-4") >= 0:
-        voice = texttospeech.VoiceSelectionParams(
-            {"language_code": "en-GB", "name": "en-GB-Neural2-B"}
-        )
-    else:
-        voice = texttospeech.VoiceSelectionParams(
-            {"language_code": "en-US", "name": "en-US-Neural2-D"}
-        )
-
-    # Configure the audio output settings
-    audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.LINEAR16,
-        speaking_rate=1.1,
-        pitch=-5.5
-    )
+    # Build the voice request and configure the audio output settings
+    voice, audio_config = gcp_voice(model)
 
     # Perform the text-to-speech request on the text input with the selected
     # voice parameters and audio file type
@@ -110,6 +101,126 @@ def text_to_speech(text: str, stream=False, model="gpt-4"):
     return output_file
 
 
+def gcp_voice(model: str, sample_rate: int = None) -> tuple:
+    """
+    Build the Google Cloud voice and audio settings used for a model.
+
+    :param model: The model used to generate the text.
+    :type model: str
+    :param sample_rate: The sample rate to ask for, the voice's own rate if not given.
+    :type sample_rate: int, optional
+    :return: The voice selection and the audio config.
+    :rtype: tuple
+    """
+    # Select the language code ("en-GB") and the voice name ("en-GB-Neural2-B")
+    if model.find("gpt-4") >= 0:
+        voice = texttospeech.VoiceSelectionParams(
+            {"language_code": "en-GB", "name": "en-GB-Neural2-B"}
+        )
+    else:
+        voice = texttospeech.VoiceSelectionParams(
+            {"language_code": "en-US", "name": "en-US-Neural2-D"}
+        )
+
+    settings = {"audio_encoding": texttospeech.AudioEncoding.LINEAR16, "speaking_rate": 1.1, "pitch": -5.5}
+    if sample_rate is not None:
+        settings["sample_rate_hertz"] = sample_rate
+    return voice, texttospeech.AudioConfig(**settings)
+
+
+def text_to_speech_chunks(text: str, model="gpt-4", chunk_frames: int = 4096) -> Tuple[int, Iterator[bytes]]:
+    """
+    Convert the given text to speech as chunks of 16-bit mono PCM, so playback can start on the first chunk.
+
+    The sample rate is fixed by the engine and known before anything is synthesized. Nothing is requested until the
+    iterator is advanced. The free voice arrives part by part, about 100 characters each, and every part is decoded
+    as soon as it arrives. Google Cloud voices arrive in one response, which is then cut into chunks.
+
+    :param text: The text to be converted to speech.
+    :type text: str
+    :param model: The model used to generate the text.
+    :type model: str
+    :param chunk_frames: The number of samples per chunk.
+    :type chunk_frames: int
+    :return: The sample rate and an iterator of PCM chunks.
+    :rtype: Tuple[int, Iterator[bytes]]
+    """
+    text = simplify_urls(re.sub("`", "", text))
+    if gcp_available:
+        return stream_sample_rate, _gcp_chunks(text, model, chunk_frames)
+    slow_flag = model.find("gpt-4") < 0
+    if sys.platform == 'darwin':
+        return say_sample_rate, _wav_chunks(lambda: free_text_to_speech(text, model=model, stream=True), chunk_frames)
+    return stream_sample_rate, _gtts_chunks(text, slow_flag, chunk_frames)
+
+
+def _gcp_chunks(text: str, model: str, chunk_frames: int) -> Iterator[bytes]:
+    """
+    Synthesize text with Google Cloud and cut it into PCM chunks, splitting the longest sentence if it is too long.
+
+    :param text: The text to be converted to speech.
+    :type text: str
+    :param model: The model used to generate the text.
+    :type model: str
+    :param chunk_frames: The number of samples per chunk.
+    :type chunk_frames: int
+    :return: An iterator of PCM chunks at stream_sample_rate.
+    :rtype: Iterator[bytes]
+    """
+    voice, audio_config = gcp_voice(model, stream_sample_rate)
+    try:
+        response = client.synthesize_speech(
+            input=texttospeech.SynthesisInput(text=text), voice=voice, audio_config=audio_config
+        )
+    except InvalidArgument as e:
+        logger.warning(f'Sentence is too long to TTS: "{text}"')
+        new = split_longest_sentence(text)
+        if new == text:
+            raise TextToSpeechError(text)
+        yield from _gcp_chunks(new, model, chunk_frames)
+        return
+    yield from _wav_chunks(lambda: response.audio_content, chunk_frames)
+
+
+def _gtts_chunks(text: str, slow: bool, chunk_frames: int) -> Iterator[bytes]:
+    """
+    Synthesize text with gTTS, decoding every part as soon as it has been downloaded.
+
+    :param text: The text to be converted to speech.
+    :type text: str
+    :param slow: Whether to use the slow voice.
+    :type slow: bool
+    :param chunk_frames: The number of samples per chunk.
+    :type chunk_frames: int
+    :return: An iterator of PCM chunks at stream_sample_rate.
+    :rtype: Iterator[bytes]
+    """
+    for mp3_part in gTTS(text, lang='en', slow=slow).stream():
+        segment = AudioSegment.from_file(io.BytesIO(mp3_part), format="mp3")
+        pcm = segment.set_channels(1).set_sample_width(2).set_frame_rate(stream_sample_rate).raw_data
+        for i in range(0, len(pcm), chunk_frames * 2):
+            yield pcm[i:i + chunk_frames * 2]
+
+
+def _wav_chunks(synthesize, chunk_frames: int) -> Iterator[bytes]:
+    """
+    Cut a mono 16-bit WAV clip into PCM chunks.
+
+    :param synthesize: Called to get the WAV bytes the first time the iterator is advanced.
+    :type synthesize: callable
+    :param chunk_frames: The number of samples per chunk.
+    :type chunk_frames: int
+    :return: An iterator of PCM chunks.
+    :rtype: Iterator[bytes]
+    """
+    with wave.open(io.BytesIO(synthesize()), 'rb') as wav_file:
+        while True:
+            pcm = wav_file.readframes(chunk_frames)
+            if not pcm:
+                return
+            yield pcm
+
+
 def simplify_urls(text):
     """
     Simplify URLs in the given text by removing the protocol and "www." and anything after the domain name.
@@ -282,7 +393,7 @@ def free_text_to_speech(text: str, model="gpt-4", stream=False):
         text_cmd = f'[[pbas {pitch}]] "{fixed_text}"'
 
         output_file = audio_folder + str(uuid.uuid4()) + ".wav"
-        subprocess.run(['say']+vflag+[text_cmd, "-o", output_file, '--data-format=LEI16@22050'])
+        subprocess.run(['say']+vflag+[text_cmd, "-o", output_file, f'--data-format=LEI16@{say_sample_rate}'])
         if not stream:
             return output_file
         with open(output_file, 'rb') as file: